@@ -1,3 +1,5 @@
-from . import preprocess, recording, signal, signals, statistics
+from . import moments, preprocess, recording, signal, signals, statistics,\
+               storage
 
-__all__ = ['preprocess', 'recording', 'signal', 'signals', 'statistics']
+__all__ = ['moments', 'preprocess', 'recording', 'signal', 'signals',
+           'statistics', 'storage']
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+import numpy as np
+import scipy
+
+class Moments:
+    def __init__(self, count=0, mean=0., m2=0.):
+        self._count = count
+        self._m2 = m2
+        self._mean = mean
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def m2(self):
+        return self._m2
+
+    @property
+    def mean(self):
+        return self._mean
+
+    def merge(self, other):
+        count = self.count + other.count
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            return other
+        delta = other.mean - self.mean
+        mean = self.mean + delta * (other.count / count)
+        m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count /
+                                               count)
+        return self.__class__(count, mean, m2)
+
+    def scale(self, factor):
+        return self.__class__(self.count, self.mean * factor,
+                              self.m2 * factor ** 2)
+
+    def update(self, data):
+        if data.shape[-1] == 0:
+            return self
+        mean = data.mean(axis=-1, keepdims=True)
+        m2 = ((data - mean) ** 2).sum(axis=-1, keepdims=True)
+        return self.merge(self.__class__(data.shape[-1], mean, m2))
+
+    def variance(self, ddof=1):
+        return self.m2 / (self.count - ddof)
+
+    @classmethod
+    def of(cls, chunks):
+        moments = cls()
+        for chunk in chunks:
+            moments = moments.update(chunk)
+        return moments
+
+class HigherMoments(Moments):
+    def __init__(self, count=0, mean=0., m2=0., m3=0., m4=0.):
+        super().__init__(count, mean, m2)
+        self._m3 = m3
+        self._m4 = m4
+
+    def kurtosis(self):
+        return self.count * self.m4 / self.m2 ** 2 - 3
+
+    @property
+    def m3(self):
+        return self._m3
+
+    @property
+    def m4(self):
+        return self._m4
+
+    def merge(self, other):
+        count = self.count + other.count
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            return other
+        na, nb = self.count, other.count
+        delta = other.mean - self.mean
+        mean = self.mean + delta * (nb / count)
+        m2 = self.m2 + other.m2 + delta ** 2 * (na * nb / count)
+        m3 = self.m3 + other.m3 + delta ** 3 * (na * nb * (na - nb) /
+                                                count ** 2)
+        m3 += 3 * delta * (na * other.m2 - nb * self.m2) / count
+        m4 = self.m4 + other.m4 + delta ** 4 * (na * nb *
+                                                (na ** 2 - na * nb + nb ** 2) /
+                                                count ** 3)
+        m4 += 6 * delta ** 2 * (na ** 2 * other.m2 + nb ** 2 * self.m2) /\
+              count ** 2
+        m4 += 4 * delta * (na * other.m3 - nb * self.m3) / count
+        return self.__class__(count, mean, m2, m3, m4)
+
+    def scale(self, factor):
+        return self.__class__(self.count, self.mean * factor,
+                              self.m2 * factor ** 2, self.m3 * factor ** 3,
+                              self.m4 * factor ** 4)
+
+    def skewness(self):
+        return np.sqrt(self.count) * self.m3 / self.m2 ** 1.5
+
+    def update(self, data):
+        if data.shape[-1] == 0:
+            return self
+        mean = data.mean(axis=-1, keepdims=True)
+        deviations = data - mean
+        squares = deviations ** 2
+        m2 = squares.sum(axis=-1, keepdims=True)
+        m3 = (squares * deviations).sum(axis=-1, keepdims=True)
+        m4 = (squares ** 2).sum(axis=-1, keepdims=True)
+        return self.merge(self.__class__(data.shape[-1], mean, m2, m3, m4))
+
+class P2Quantiles:
+    def __init__(self, quantiles=(0.5,), dtype=np.float64):
+        self._count = 0
+        self._dtype = np.dtype(dtype)
+        self._heights = None
+        self._positions = None
+        self._quantiles = np.asarray(quantiles, dtype=np.float64)
+        assert ((self._quantiles >= 0) & (self._quantiles <= 1)).all()
+
+        ps = self._quantiles[:, np.newaxis]
+        self._desired = np.array([0., 0., 0., 2., 4.]) + ps * [0, 2, 4, 2, 0]
+        self._increments = np.array([0., 0., 0., 0.5, 1.]) +\
+                           ps * [0, 0.5, 1, 0.5, 0]
+
+    @property
+    def count(self):
+        return self._count
+
+    def _observe(self, x):
+        x = x[..., np.newaxis, np.newaxis]
+        heights, positions = self._heights, self._positions
+        np.minimum(heights[..., :1], x, out=heights[..., :1])
+        np.maximum(heights[..., 4:], x, out=heights[..., 4:])
+        cell = (heights[..., 1:4] <= x).sum(axis=-1, keepdims=True)
+        positions += np.arange(5) > cell
+        self._desired += self._increments
+
+        for i in range(1, 4):
+            d = self._desired[:, i] - positions[..., i]
+            above = positions[..., i + 1] - positions[..., i]
+            below = positions[..., i - 1] - positions[..., i]
+            move = ((d >= 1) & (above > 1)) | ((d <= -1) & (below < -1))
+            if not move.any():
+                continue
+            ds = np.where(d >= 0, 1., -1.)
+            q, n = heights[..., i], positions[..., i]
+            qa, qb = heights[..., i + 1], heights[..., i - 1]
+            na, nb = positions[..., i + 1], positions[..., i - 1]
+            parabolic = q + ds / (na - nb) * ((n - nb + ds) * (qa - q) /
+                                              (na - n) +
+                                              (na - n - ds) * (q - qb) /
+                                              (n - nb))
+            linear = np.where(ds > 0, q + (qa - q) / (na - n),
+                              q - (qb - q) / (nb - n))
+            parabolic = np.where((qb < parabolic) & (parabolic < qa),
+                                 parabolic, linear)
+            heights[..., i] = np.where(move, parabolic, q)
+            positions[..., i] += np.where(move, ds, 0)
+
+    @property
+    def quantiles(self):
+        return self._quantiles
+
+    def result(self):
+        if self.count < 5:
+            data = self._heights[..., 0, :self.count]
+            return np.moveaxis(np.quantile(data, self.quantiles, axis=-1),
+                               0, -1)
+        return self._heights[..., 2].copy()
+
+    def update(self, data):
+        for trial in np.moveaxis(data.astype(self._dtype, copy=False), -1, 0):
+            if self._heights is None:
+                self._heights = np.empty(trial.shape + (len(self.quantiles),
+                                                        5), self._dtype)
+            if self.count < 5:
+                self._heights[..., self.count] = trial[..., np.newaxis]
+                self._count += 1
+                if self.count == 5:
+                    self._heights.sort(axis=-1)
+                    self._positions = np.broadcast_to(
+                        np.arange(5, dtype=np.float64),
+                        self._heights.shape
+                    ).copy()
+                continue
+            self._observe(trial)
+            self._count += 1
+        return self
+
+def t_stats(ln, lmean, lvar, rn, rmean, rvar):
+    l_stderr, r_stderr = lvar / ln, rvar / rn
+    ts = (lmean - rmean) / np.sqrt(l_stderr + r_stderr)
+    dfs = (l_stderr + r_stderr) ** 2
+    dfs /= l_stderr ** 2 / (ln - 1) + r_stderr ** 2 / (rn - 1)
+    pvals = scipy.special.stdtr(dfs, -np.abs(ts)) * 2
+    return ts, pvals
+
+def welch_t_test(left: Moments, right: Moments):
+    return t_stats(left.count, left.mean, left.variance(), right.count,
+                   right.mean, right.variance())
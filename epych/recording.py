@@ -2,18 +2,22 @@
 
 from collections import Counter
 import collections.abc as abc
+import concurrent.futures
 import copy
 import functools
+import h5py
 import math
 import numpy as np
+import operator
 import os
 import matplotlib.pyplot as plt
 import pandas as pd
 import pickle
 import quantities as pq
+from tqdm import tqdm
 import typing
 
-from . import preprocess, signal
+from . import preprocess, signal, storage
 
 def empty_intervals():
     return pd.DataFrame(columns=["trial", "type", "start", "end"])
@@ -24,6 +28,84 @@ def empty_trials():
 def default_units(time_unit=pq.second):
     return {"start": pq.second, "end": pq.second}
 
+def epoch_signals(signals, intervals, time_shift=0., workers=None):
+    indices = {}
+    for v in signals.values():
+        key = v.time_grid_key()
+        if key not in indices:
+            indices[key] = (v.samples_at(intervals[:, 0]),
+                            v.samples_at(intervals[:, 1]))
+    def epoch(v):
+        return v.epoch(intervals, time_shift,
+                       indices=indices[v.time_grid_key()])
+    if len(signals) <= 1:
+        return {k: epoch(v) for k, v in signals.items()}
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {k: pool.submit(epoch, v) for k, v in signals.items()}
+    return {k: future.result() for k, future in futures.items()}
+
+def _map_signals(f, items, workers=1, processes=False, desc=None):
+    items = list(items)
+    results = {}
+    with tqdm(total=len(items), desc=desc, disable=desc is None) as progress:
+        if workers == 1:
+            for k, v in items:
+                results[k] = f(k, v)
+                progress.set_postfix_str(k)
+                progress.update()
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor if processes\
+                       else concurrent.futures.ThreadPoolExecutor
+            with executor(workers) as pool:
+                futures = {pool.submit(f, k, v): k for k, v in items}
+                for future in concurrent.futures.as_completed(futures):
+                    results[futures[future]] = future.result()
+                    progress.set_postfix_str(futures[future])
+                    progress.update()
+    return {k: results[k] for k, _ in items}
+
+def _apply_shared(f, keys, k, sig, shared):
+    sig._data = shared.array()
+    result = f(k, sig) if keys else f(sig)
+    if isinstance(result, signal.Signal) and\
+       isinstance(result._data, np.ndarray) and\
+       np.may_share_memory(result._data, sig._data):
+        result = result.fmap(lambda data: data.copy(), magnitude=True)
+    sig._data = None
+    return result
+
+def map_signals(f, signals, keys=False, executor=None):
+    if executor is None:
+        return {k: f(k, v) if keys else f(v) for k, v in signals.items()}
+
+    processes = isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+    futures, shared = {}, []
+    try:
+        for k, v in signals.items():
+            if processes and (isinstance(v._data, np.ndarray) or
+                              storage.is_lazy(v._data)):
+                # Lazy data holds open file handles, so read it here.
+                shared.append(storage.SharedArray(v.magnitude))
+                v = copy.copy(v)
+                v._data = None
+                futures[k] = executor.submit(_apply_shared, f, keys, k, v,
+                                             shared[-1])
+            else:
+                futures[k] = executor.submit(f, k, v) if keys else\
+                             executor.submit(f, v)
+        return {k: future.result() for k, future in futures.items()}
+    finally:
+        for array in shared:
+            array.release()
+
+def _merge_trials(trials):
+    merged = trials[0]
+    for other in trials[1:]:
+        merged = merged.merge(
+            other, on=list(set(merged.columns) & set(other.columns)) + ["trial"]
+        )
+    return merged
+
 class Sampling(abc.Sequence):
     def __init__(self, intervals: pd.DataFrame, trials: pd.DataFrame,
                  units: dict[str, pq.UnitQuantity], **signals):
@@ -36,25 +118,19 @@ class Sampling(abc.Sequence):
         assert isinstance(units["start"], pq.UnitTime) and\
                isinstance(units["end"], pq.UnitTime)
         self._intervals = intervals
+        self._owned_signals = set()
         self._signals = signals
         self._trials = trials
         self._units = units
 
     def __add__(self, other):
-        assert self.signals.keys() == other.signals.keys()
-        trials = self.trials.merge(
-            other.trials,
-            on=list(set(self.trials.columns) & set(other.trials.columns)) + ["trial"]
-        )
-        assert self.units == other.units
-        intervals = empty_intervals()
-        signals = {k: self.signals[k] + other.signals[k] for k in self.signals}
-        return self.__class__(intervals, trials, self.units, **signals)
+        return self.combine([self, other])
 
-    def baseline_correct(self, start, stop):
-        return self.smap(lambda v: v.baseline_correct(start, stop))
+    def baseline_correct(self, start, stop, executor=None):
+        return self.smap(operator.methodcaller("baseline_correct", start, stop),
+                         executor=executor)
 
-    def erp(self):
+    def erp(self, executor=None):
         intervals = []
         for epoch_type in self.intervals["type"].unique():
             epochs = self.intervals.loc[self.intervals["type"] == epoch_type]
@@ -72,7 +148,8 @@ class Sampling(abc.Sequence):
                               columns=trials.index.values)
         trials = trials.assign(trial=[0]).set_index("trial")
 
-        signals = {k: v.evoked() for k, v in self.signals.items()}
+        signals = map_signals(operator.methodcaller("evoked"), self.signals,
+                              executor=executor)
         return EvokedSampling(intervals, trials, self.units, **signals)
 
     def __getitem__(self, key):
@@ -84,26 +161,70 @@ class Sampling(abc.Sequence):
         intervals = np.repeat([key.start, key.stop], len(self.trials), axis=-1)
         return self.time_lock(intervals)
 
+    def __iadd__(self, other):
+        return self._accumulate(other, 1)
+
+    def _accumulate(self, other, weight):
+        assert self.signals.keys() == other.signals.keys()
+        assert self.units == other.units
+        self._trials = _merge_trials([self.trials, other.trials])
+        self._intervals = empty_intervals()
+        # Signals are only accumulated in place once this sampling has made
+        # its own copies of them, so samplings sharing signals stay intact.
+        owned, signals = getattr(self, "_owned_signals", set()), {}
+        for k, v in self.signals.items():
+            if k in owned:
+                signals[k] = v._accumulate(other.signals[k], weight)
+            else:
+                signals[k] = signal.sum_signals([v, other.signals[k]],
+                                                weights=[1, weight])
+        self._owned_signals, self._signals = set(signals), signals
+        return self
+
     @property
     def intervals(self):
         return self._intervals
 
+    def __isub__(self, other):
+        return self._accumulate(other, -1)
+
     def __len__(self):
         return math.min(len(signal) for signal in self.signals.values())
 
-    def pickle(self, path):
+    def lazy(self, chunk_trials=16):
+        return self.smap(lambda v: v.lazy(chunk_trials))
+
+    def pickle(self, path, workers=1, processes=False, progress=False):
         assert os.path.isdir(path) or not os.path.exists(path)
         os.makedirs(path, exist_ok=True)
 
         self.intervals.to_csv(path + "/intervals.csv")
         self.trials.to_csv(path + "/trials.csv")
         for k, v in self.signals.items():
-            v.pickle(path + "/" + k)
+            assert os.path.isdir(path + "/" + k) or\
+                   not os.path.exists(path + "/" + k)
+            os.makedirs(path + "/" + k, exist_ok=True)
+            v._pickle_metadata(path + "/" + k)
+        _map_signals(functools.partial(_pickle_signal, path),
+                     self.signals.items(), workers=workers,
+                     processes=processes, desc="pickle" if progress else None)
         other = copy.copy(self)
         other._intervals = other._signals = other._trials = None
         with open(path + "/sampling.pickle", mode="wb") as f:
             pickle.dump(other, f)
 
+    def save(self, filename, **kwargs):
+        with h5py.File(filename, mode="w") as f:
+            storage.write_frame(f, "intervals", self.intervals)
+            storage.write_frame(f, "trials", self.trials)
+            other = copy.copy(self)
+            other._intervals = other._signals = other._trials = None
+            storage.write_object(f, "sampling", other)
+
+            signals = f.create_group("signals")
+            for k, v in self.signals.items():
+                v.save(signals.create_group(k), **kwargs)
+
     def select_trials(self, selections):
         trials = self.trials.loc[selections]
         signals = {k: s.select_trials(selections) for k, s
@@ -114,30 +235,15 @@ class Sampling(abc.Sequence):
     def signals(self):
         return self._signals
 
-    def smap(self, f, keys=False):
-        if keys:
-            signals = {
-                k: f(k, v) for k, v in self.signals.items()
-            }
-        else:
-            signals = {
-                k: f(v) for k, v in self.signals.items()
-            }
+    def smap(self, f, keys=False, executor=None):
+        signals = map_signals(f, self.signals, keys=keys, executor=executor)
         return self.__class__(self.intervals, self.trials, self.units,
                               **signals)
 
     def __sub__(self, other):
-        assert self.signals.keys() == other.signals.keys()
-        trials = self.trials.merge(
-            other.trials,
-            on=list(set(self.trials.columns) & set(other.trials.columns)) + ["trial"]
-        )
-        assert self.units == other.units
-        intervals = empty_intervals()
-        signals = {k: self.signals[k] - other.signals[k] for k in self.signals}
-        return self.__class__(intervals, trials, self.units, **signals)
+        return self.combine([self, other], weights=[1, -1])
 
-    def time_lock(self, times, before=0., after=0.):
+    def time_lock(self, times, before=0., after=0., workers=None):
         if isinstance(times, float):
             times = np.ones(len(self.trials)) * times
         onsets, offsets = times - before, times + after
@@ -146,8 +252,8 @@ class Sampling(abc.Sequence):
         inner_intervals = self.intervals.loc[inner_intervals]
         intervals = np.stack((onsets, offsets), axis=-1)
         return self.__class__(inner_intervals, self.trials, self.units,
-                              **{k: v.epoch(intervals, -before) for k, v
-                              in self.signals.items()})
+                              **epoch_signals(self.signals, intervals, -before,
+                                              workers=workers))
 
     @property
     def trials(self):
@@ -158,20 +264,117 @@ class Sampling(abc.Sequence):
         return self._units
 
     @classmethod
-    def unpickle(cls, path):
+    def combine(cls, samplings, weights=None):
+        first = samplings[0]
+        for other in samplings[1:]:
+            assert first.signals.keys() == other.signals.keys()
+            assert first.units == other.units
+        trials = _merge_trials([sampling.trials for sampling in samplings])
+        signals = {
+            k: signal.sum_signals([sampling.signals[k] for sampling
+                                   in samplings], weights=weights)
+            for k in first.signals
+        }
+        return first.__class__(empty_intervals(), trials, first.units,
+                               **signals)
+
+    @classmethod
+    def load(cls, filename, lazy=False, signals=None, dtype=None):
+        f = h5py.File(filename, mode="r")
+        self = storage.read_object(f, "sampling")
+        self._signals = {}
+        for entry in sorted(f["signals"].keys()):
+            if signals is not None and entry not in signals:
+                continue
+            self._signals[entry] =\
+                signal.EpochedSignal.load(f["signals"][entry], lazy=lazy,
+                                          dtype=dtype)
+        self._trials = storage.read_frame(f, "trials", index_col="trial")
+        self._intervals = storage.read_frame(f, "intervals", index_col=0)
+        if not lazy:
+            f.close()
+        return self
+
+    @classmethod
+    def open(cls, path, signals=None, channels=None, trials=None, times=None,
+             dtype=None):
+        self = cls.unpickle(path, lazy=True, signals=signals, dtype=dtype)
+        if trials is not None:
+            self = self.select_trials(trials)
+
+        opened = {}
+        for k, v in self.signals.items():
+            mask = channels.get(k) if isinstance(channels, dict) else channels
+            if mask is not None:
+                v = v.select_channels(mask)
+            if times is not None:
+                v = v[times]
+            opened[k] = v.fmap(lambda data: data)
+        return self.__class__(self.intervals, self.trials, self.units,
+                              **opened)
+
+    @classmethod
+    def unpickle(cls, path, lazy=False, signals=None, dtype=None, workers=1,
+                 processes=False, progress=False):
+        if os.path.isfile(path):
+            return cls.load(path, lazy=lazy, signals=signals, dtype=dtype)
         assert os.path.isdir(path)
 
         with open(path + "/sampling.pickle", mode="rb") as f:
             self = pickle.load(f)
-        self._signals = {}
-        ls = [entry.name for entry in os.scandir(path) if entry.is_dir()]
-        for entry in sorted(ls):
-            self._signals[entry] =\
-                signal.EpochedSignal.unpickle(path + "/" + entry)
+        ls = [entry.name for entry in os.scandir(path) if entry.is_dir() and
+              (signals is None or entry.name in signals)]
+        unpickle = functools.partial(_unpickle_signal, path, lazy, dtype)
+        self._signals = _map_signals(unpickle, ((entry, entry) for entry
+                                                in sorted(ls)),
+                                     workers=workers, processes=processes,
+                                     desc="unpickle" if progress else None)
         self._trials = pd.read_csv(path + "/trials.csv", index_col="trial")
         self._intervals = pd.read_csv(path + "/intervals.csv")
         return self
 
+def _pickle_signal(path, k, v):
+    v._pickle_arrays(path + "/" + k)
+
+def _unpickle_signal(path, lazy, dtype, k, entry):
+    return signal.EpochedSignal.unpickle(path + "/" + entry, lazy=lazy,
+                                         dtype=dtype)
+
+def _contained(starts, ends, onsets, offsets):
+    order = np.argsort(starts, kind="stable")
+    sorted_starts = starts[order]
+    lows = np.searchsorted(sorted_starts, onsets, side="right")
+    highs = np.searchsorted(sorted_starts, offsets, side="left")
+    counts = np.maximum(highs - lows, 0)
+    outers = np.repeat(np.arange(len(onsets)), counts)
+    firsts = np.repeat(lows - np.cumsum(counts) + counts, counts)
+    inners = order[firsts + np.arange(counts.sum())]
+    mask = ends[inners] < offsets[outers]
+    outers, inners = outers[mask], inners[mask]
+    order = np.lexsort((inners, outers))
+    return outers[order], inners[order]
+
+def _containing(starts, ends, inner_starts, inner_ends, block=1024):
+    if len(starts) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    order = np.argsort(starts, kind="stable")
+    sorted_starts, sorted_ends = starts[order], ends[order]
+    if (sorted_ends[:-1] <= sorted_starts[1:]).all():
+        parents = np.searchsorted(sorted_starts, inner_starts, side="left") - 1
+        found = parents >= 0
+        parents = order[np.maximum(parents, 0)]
+        found &= (starts[parents] < inner_starts) & (inner_ends < ends[parents])
+        return np.flatnonzero(found), parents[found]
+
+    inners, parents = [], []
+    for b in range(0, len(inner_starts), block):
+        contains = (starts < inner_starts[b:b+block, np.newaxis]) &\
+                   (inner_ends[b:b+block, np.newaxis] < ends)
+        found = contains.any(axis=-1)
+        inners.append(np.flatnonzero(found) + b)
+        parents.append(contains.argmax(axis=-1)[found])
+    return np.concatenate(inners), np.concatenate(parents)
+
 class RawRecording(Sampling):
     def __init__(self, intervals: pd.DataFrame, trials: pd.DataFrame,
                  units: dict[str, pq.UnitQuantity], **signals):
@@ -180,7 +383,8 @@ class RawRecording(Sampling):
             assert isinstance(v, signal.RawSignal)
         super().__init__(intervals, trials, units, **signals)
 
-    def epoch(self, inner_epochs, outer_epochs=None, before=0., after=0.):
+    def epoch(self, inner_epochs, outer_epochs=None, before=0., after=0.,
+              workers=None):
         assert hasattr(after, "units")
         assert hasattr(before, "units")
         after = after.rescale(self.units["start"])
@@ -189,15 +393,11 @@ class RawRecording(Sampling):
         targets = self.intervals.loc[inner_epochs]
         if outer_epochs is not None:
             parent = self.intervals.loc[outer_epochs]
-
-            mask = []
-            target_times = zip(targets["start"], targets["end"])
-            for t, (start, end) in enumerate(target_times):
-                idx = np.where((parent["start"] < start) & (end < parent["end"]))[0]
-                if len(idx):
-                    mask.append((targets.index[t], idx[0]))
-            mask = np.array(mask)
-            targets, epochs = targets.loc[mask[:, 0]], parent.loc[mask[:, 1]]
+            tpos, ppos = _containing(parent["start"].values,
+                                     parent["end"].values,
+                                     targets["start"].values,
+                                     targets["end"].values)
+            targets, epochs = targets.iloc[tpos], parent.iloc[ppos]
         else:
             epochs = targets
         assert len(targets) == len(epochs)
@@ -205,38 +405,28 @@ class RawRecording(Sampling):
         befores = befores * self.units["start"] + before
         afters = (epochs["end"].values - targets["end"].values).mean()
         afters = afters * self.units["end"] + after
-        onsets, offsets = targets["start"] - befores, targets["end"] + afters
-
-        epoch_intervals = np.stack((onsets.values, offsets.values), axis=-1)
-        trials = []
-        for t, (onset, offset) in enumerate(epoch_intervals):
-            inners = (self.intervals["start"] > onset) &\
-                     (self.intervals["end"] < offset)
-            inners = self.intervals.loc[inners]
-            inners = inners.assign(trial=[t] * len(inners))
-            inners.loc[:, "start":"end"] -= onset
-            for inner in inners.itertuples():
-                remainder = {
-                    k: v for k, v in inner._asdict().items() if k not in
-                    {"trial", "type", "start", "end", "Index"}
-                }
-                trials.append({
-                    "trial": t,
-                    inner.type + "_start": inner.start - befores.magnitude,
-                    inner.type + "_end": inner.end - befores.magnitude,
-                    **remainder
-                })
-        trial_columns = [set(trial.keys()) for trial in trials]
-        trial_columns = trial_columns[0].union(*trial_columns[1:])
-        trials = {
-            k: [trial[k] if (k in trial) else pd.NA for trial in trials]
-            for k in trial_columns
-        }
-        trials = pd.DataFrame(data=trials,
-                              columns=list(trial_columns)).set_index("trial")
+        onsets = targets["start"].values - befores.magnitude
+        offsets = targets["end"].values + afters.magnitude
+
+        epoch_intervals = np.stack((onsets, offsets), axis=-1)
+        trials, inners = _contained(self.intervals["start"].values,
+                                    self.intervals["end"].values, onsets,
+                                    offsets)
+        inners = self.intervals.iloc[inners].reset_index(drop=True)
+        starts = inners["start"].values - onsets[trials] - befores.magnitude
+        ends = inners["end"].values - onsets[trials] - befores.magnitude
+        columns = {"trial": trials}
+        for kind in inners["type"].unique():
+            mask = (inners["type"] == kind).values
+            columns[kind + "_start"] = np.where(mask, starts, np.nan)
+            columns[kind + "_end"] = np.where(mask, ends, np.nan)
+        for column in inners.columns:
+            if column not in {"trial", "type", "start", "end"}:
+                columns[column] = inners[column].values
+        trials = pd.DataFrame(columns).set_index("trial")
         trials = trials.groupby("trial").sum()
-        signals = {k: s.epoch(epoch_intervals, -befores) for k, s in
-                   self.signals.items()}
+        signals = epoch_signals(self.signals, epoch_intervals, -befores,
+                                workers=workers)
         return Sampling(empty_intervals(), trials, self.units, **signals)
 
 class EvokedSampling(Sampling):
@@ -316,18 +506,16 @@ class EvokedSampling(Sampling):
                              vmax=vmaxs.get(sig, None), figargs=figargs,
                              sigtitle=sigtitle, cmap=cmap, **events)
 
-def trials_ttest(sa: Sampling, sb: Sampling, pvalue=0.05):
+def trials_ttest(sa: Sampling, sb: Sampling, pvalue=0.05, chunk_trials=16):
     assert isinstance(sa, Sampling)
     assert sa.__class__ == sb.__class__
     assert sa.signals.keys() == sb.signals.keys()
-    trials = sa.trials.merge(
-        sb.trials,
-        on=list(set(sa.trials.columns) & set(sb.trials.columns)) + ["trial"]
-    )
+    trials = _merge_trials([sa.trials, sb.trials])
     assert sa.units == sb.units
     intervals = empty_intervals()
     signals = {
-        k: signal.trials_ttest(sa.signals[k], sb.signals[k], pvalue=pvalue)
+        k: signal.trials_ttest(sa.signals[k], sb.signals[k], pvalue=pvalue,
+                               chunk_trials=chunk_trials)
         for k in sa.signals
     }
     return sa.__class__(intervals, trials, sa.units, **signals)
@@ -2,30 +2,329 @@
 
 import collections
 import collections.abc
+import concurrent.futures
 import copy
+import functools
+import hashlib
 import hdf5storage as mat
 import math
 import matplotlib.pyplot as plt
 import numpy as np
+import operator
 import os
 import pandas as pd
 import pickle
+import quantities as pq
 import scipy
 
-from . import plotting
+from . import moments, plotting, storage
+
+_default_dtype = None
+
+def default_dtype():
+    return _default_dtype
+
+def set_default_dtype(dtype):
+    global _default_dtype
+    _default_dtype = None if dtype is None else np.dtype(dtype)
+
+def _resolve_dtype(dtype):
+    return default_dtype() if dtype is None else np.dtype(dtype)
+
+TRIAL_BLOCK_BYTES = 256 * 2 ** 20
+
+def _map_trials(f, data, workers=None, block_bytes=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if block_bytes is None:
+        block_bytes = TRIAL_BLOCK_BYTES
+    num_trials = data.shape[-1]
+    trial_bytes = max(data[..., 0].nbytes, 1) if num_trials else 1
+    block = max(block_bytes // (trial_bytes * workers), 1)
+    blocks = [slice(b, b + block) for b in range(0, num_trials, block)]
+    if len(blocks) <= 1:
+        return f(data)
+
+    first = f(data[..., blocks[0]])
+    result = np.empty(first.shape[:-1] + (num_trials,), dtype=first.dtype)
+    result[..., blocks[0]] = first
+    del first
+    def run(trials):
+        result[..., trials] = f(data[..., trials])
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for future in [pool.submit(run, b) for b in blocks[1:]]:
+            future.result()
+    return result
+
+def _baseline_trials(start, stop, data):
+    return data - data[:, start:stop].mean(axis=1)[:, np.newaxis, :]
+
+def _median_trials(cs, dtype, data):
+    return scipy.ndimage.median_filter(data, size=(cs, 1, 1), output=dtype)
+
+def _to_quantities(args):
+    if isinstance(args, UniformTimes):
+        return args.to_quantity()
+    if isinstance(args, (list, tuple)):
+        return args.__class__(_to_quantities(arg) for arg in args)
+    if isinstance(args, dict):
+        return {k: _to_quantities(v) for k, v in args.items()}
+    return args
+
+_COMPARISONS = {np.equal, np.not_equal, np.less, np.less_equal, np.greater,
+                np.greater_equal}
+
+class UniformTimes:
+    def __init__(self, t0, dt, n):
+        if not hasattr(t0, "units"):
+            t0 = t0 * dt.units
+        self._t0 = t0.rescale(dt.units)
+        self._dt = dt
+        self._n = int(n)
+
+    def __add__(self, other):
+        if isinstance(other, UniformTimes) and len(other) == len(self):
+            other = other.rescale(self.units)
+            return self.__class__(self.t0 + other.t0, self.dt + other.dt,
+                                  len(self))
+        if np.ndim(other) == 0 and not isinstance(other, UniformTimes):
+            return self.__class__(self.t0 + other, self.dt, len(self))
+        return self.to_quantity() + _to_quantities(other)
+
+    def allclose(self, other, rtol=1e-05, atol=1e-08):
+        if len(self) != len(other):
+            return False
+        if not isinstance(other, UniformTimes):
+            return np.allclose(self.to_quantity(), other, rtol=rtol,
+                               atol=atol)
+        other = other.rescale(self.units)
+        last = len(self) - 1
+        return bool(abs(self.t0 - other.t0) <= atol + rtol * abs(other.t0)) and\
+               bool(abs(self[last] - other[last]) <=
+                    atol + rtol * abs(other[last]))
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.to_quantity()
+        return self.magnitude.astype(dtype)
+
+    def __array_function__(self, func, types, args, kwargs):
+        return func(*_to_quantities(args), **_to_quantities(kwargs))
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if ufunc in _COMPARISONS and\
+           any(not hasattr(arg, "units") for arg in inputs):
+            # Quantity comparisons hand over their bare magnitude.
+            inputs = tuple(arg.magnitude if isinstance(arg, UniformTimes)
+                           else arg for arg in inputs)
+        return getattr(ufunc, method)(*_to_quantities(inputs),
+                                      **_to_quantities(kwargs))
+
+    def _compare(self, op, other):
+        return op(self.to_quantity(), _to_quantities(other))
+
+    @property
+    def dt(self):
+        return self._dt
+
+    @property
+    def dtype(self):
+        return self.magnitude[:1].dtype
+
+    def __eq__(self, other):
+        return self._compare(operator.eq, other)
+
+    def __ge__(self, other):
+        return self._compare(operator.ge, other)
+
+    def __getattr__(self, name):
+        # Anything UniformTimes does not implement falls back to the array.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.to_quantity(), name)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.t0 + range(len(self))[key] * self.dt
+        if isinstance(key, slice):
+            indices = range(len(self))[key]
+            return self.__class__(self.t0 + indices.start * self.dt,
+                                  self.dt * indices.step, len(indices))
+        return self.to_quantity()[key]
+
+    def __gt__(self, other):
+        return self._compare(operator.gt, other)
+
+    def item(self):
+        assert len(self) == 1
+        return self.t0.item()
+
+    def __iter__(self):
+        return iter(self.to_quantity())
+
+    def __le__(self, other):
+        return self._compare(operator.le, other)
+
+    def __len__(self):
+        return self._n
+
+    def __lt__(self, other):
+        return self._compare(operator.lt, other)
+
+    @property
+    def magnitude(self):
+        return np.arange(len(self)) * self.dt.magnitude + self.t0.magnitude
+
+    def __mul__(self, other):
+        if np.ndim(other) == 0:
+            return self.__class__(self.t0 * other, self.dt * other, len(self))
+        return self.to_quantity() * _to_quantities(other)
+
+    def __ne__(self, other):
+        return self._compare(operator.ne, other)
+
+    def __neg__(self):
+        return self * -1
+
+    @property
+    def ndim(self):
+        return 1
+
+    def __radd__(self, other):
+        return self + other
+
+    def __repr__(self):
+        return "%s(t0=%s, dt=%s, n=%d)" % (self.__class__.__name__, self.t0,
+                                           self.dt, len(self))
+
+    def rescale(self, units):
+        return self.__class__(self.t0.rescale(units), self.dt.rescale(units),
+                              len(self))
+
+    def __rmul__(self, other):
+        return self * other
+
+    def __rsub__(self, other):
+        return -self + other
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def size(self):
+        return len(self)
+
+    def __sub__(self, other):
+        if isinstance(other, UniformTimes) or np.ndim(other) == 0:
+            return self + -other
+        return self.to_quantity() - _to_quantities(other)
+
+    @property
+    def t0(self):
+        return self._t0
+
+    def to_quantity(self):
+        return pq.Quantity(self.magnitude, self.units)
+
+    def __truediv__(self, other):
+        if np.ndim(other) == 0:
+            return self * (1. / other)
+        return self.to_quantity() / _to_quantities(other)
+
+    @property
+    def units(self):
+        return self.dt.units
+
+    @classmethod
+    def from_times(cls, times, rtol=1e-6):
+        if isinstance(times, cls) or not hasattr(times, "units") or\
+           len(times) < 2:
+            return times
+        steps = np.diff(times.magnitude)
+        if not (steps > 0).all() or\
+           not np.allclose(steps, steps.mean(), rtol=rtol, atol=0.):
+            return times
+        dt = (times[-1] - times[0]) / (len(times) - 1)
+        return cls(times[0], dt, len(times))
+
+def _as_slice(selection, length):
+    if isinstance(selection, (slice, int, np.integer)):
+        return selection
+    indices = np.asarray(selection)
+    if indices.dtype == bool:
+        assert len(indices) == length
+        indices = np.flatnonzero(indices)
+    if indices.ndim != 1 or not np.issubdtype(indices.dtype, np.integer):
+        return selection
+    indices = np.where(indices < 0, indices + length, indices)
+    if len(indices) == 0:
+        return slice(0, 0)
+    steps = np.diff(indices)
+    if len(steps) and (steps[0] <= 0 or (steps != steps[0]).any()):
+        return indices
+    step = steps[0] if len(steps) else 1
+    return slice(indices[0], indices[-1] + 1, step)
+
+def channels_fingerprint(channels):
+    hashes = pd.util.hash_pandas_object(channels, index=True).values
+    digest = hashlib.sha1(hashes.tobytes())
+    digest.update(repr((list(channels.columns), channels.index.name)).encode())
+    return digest.hexdigest()
+
+def same_channels(a, b):
+    if a._channels is b._channels or\
+       a.channels_fingerprint == b.channels_fingerprint:
+        return True
+    return bool((a._channels == b._channels).all().all())
+
+def times_allclose(a, b, rtol=1e-05, atol=1e-08):
+    if isinstance(a, UniformTimes):
+        return a.allclose(b, rtol=rtol, atol=atol)
+    if isinstance(b, UniformTimes):
+        return b.allclose(a, rtol=rtol, atol=atol)
+    return np.allclose(a, b, rtol=rtol, atol=atol)
 
 class Signal(collections.abc.Sequence):
     def __init__(self, channels: pd.DataFrame, data, dt, timestamps):
         assert len(data.shape) >= 2
 
-        self._channels = channels
-        self._data = data
+        self.channels = channels
+        self._data = data.magnitude if isinstance(data, pq.Quantity) else data
         self._dt = dt
+        self._grid = None
+        self._owned = False
         self._timestamps = timestamps
+        self._units = getattr(data, "units", None)
+
+    def astype(self, dtype):
+        data = self._wrap(self._data.astype(dtype, copy=False))
+        return self._share(self._keep_channels(
+            self.__class__(self._channels, data, self.dt, self.times)
+        ))
 
     @property
     def channels(self):
-        return self._channels
+        # Signals share one private table and its fingerprint, so callers get
+        # a copy and change channels by assigning them.
+        return self._channels.copy()
+
+    @channels.setter
+    def channels(self, channels):
+        self._channels = channels.copy()
+        self._fingerprint = [None]
+
+    @property
+    def channels_fingerprint(self):
+        if self._fingerprint[0] is None:
+            self._fingerprint[0] = channels_fingerprint(self._channels)
+        return self._fingerprint[0]
+
+    @property
+    def data(self):
+        if self.units is None:
+            return self.magnitude
+        return pq.Quantity(self.magnitude, self.units)
 
     @property
     def df(self):
@@ -35,6 +334,10 @@ class Signal(collections.abc.Sequence):
     def dt(self):
         return self._dt
 
+    @property
+    def dtype(self):
+        return self._data.dtype
+
     def _data_slices(self, channels, times, trials):
         if channels is None:
             channels = slice(0, self.num_channels, 1)
@@ -44,9 +347,7 @@ class Signal(collections.abc.Sequence):
             if channels.step is None:
                 channels = slice(channels.start, channels.stop, 1)
         if times is None:
-            times = self.times.magnitude if hasattr(self.times, 'units')\
-                    else self.times
-            times = slice(times[0], times[-1], None)
+            times = slice(self.times[0], self.times[-1], None)
         else:
             if isinstance(times, int):
                 times = slice(times, times+1, None)
@@ -65,9 +366,21 @@ class Signal(collections.abc.Sequence):
     def f0(self):
         return 1. / self.dt
 
-    def fmap(self, f):
-        return self.__class__(self.channels, f(self.data), self.dt,
-                              self.times)
+    def fmap(self, f, magnitude=False, trialwise=False, workers=None):
+        if magnitude and trialwise and storage.is_lazy(self._data):
+            data = self._data
+            if not isinstance(data, storage.LazyMap):
+                data = storage.LazyMap(data, self.units)
+            data = data.map(f)
+        elif magnitude and trialwise:
+            data = self._wrap(_map_trials(f, self.magnitude, workers))
+        elif magnitude:
+            data = self._wrap(f(self.magnitude))
+        else:
+            data = f(self.data)
+        return self._share(self._keep_channels(
+            self.__class__(self._channels, data, self.dt, self.times)
+        ))
 
     @property
     def fNQ(self):
@@ -82,6 +395,15 @@ class Signal(collections.abc.Sequence):
     def __len__(self):
         return len(self._timestamps)
 
+    @property
+    def magnitude(self):
+        return storage.materialize(self._data)
+
+    def _magnitude_in(self, units):
+        if units == self.units:
+            return self.magnitude
+        return self.data.rescale(units).magnitude
+
     @property
     def num_channels(self):
         return len(self._channels)
@@ -91,11 +413,78 @@ class Signal(collections.abc.Sequence):
         raise NotImplementedError
 
     def sample_at(self, t):
-        if hasattr(self._timestamps, "units"):
-            times = self._timestamps.magnitude
+        return self.samples_at(t).item()
+
+    def samples_at(self, ts):
+        times = self._timestamps
+        if hasattr(ts, "units") and hasattr(times, "units"):
+            ts = ts.rescale(times.units)
+        ts = np.asarray(getattr(ts, "magnitude", ts), dtype=float)
+
+        grid = self._time_grid()
+        if grid[0] == "uniform" and isinstance(times, UniformTimes):
+            _, t0, dt = grid
+            time_at = lambda i: t0 + i * dt
         else:
+            times = times.magnitude if hasattr(times, "units") else times
+            time_at = lambda i: times[i]
+
+        if grid[0] == "unsorted":
+            return np.nanargmin(np.abs(times - ts[..., np.newaxis]), axis=-1)
+        if grid[0] == "uniform":
+            _, t0, dt = grid
+            right = np.floor((ts - t0) / dt).astype(np.intp) + 1
+        else:
+            right = np.searchsorted(times, ts)
+        right = np.clip(right, 1, len(self) - 1)
+        left = right - 1
+        return np.where(np.abs(ts - time_at(left)) <=
+                        np.abs(time_at(right) - ts), left, right)
+
+    def time_grid_key(self):
+        grid = self._time_grid()
+        if grid[0] == "uniform":
+            units = getattr(self._timestamps, "units", None)
+            return grid + (len(self), str(units))
+        return ("explicit", id(self._timestamps))
+
+    def _time_grid(self):
+        if getattr(self, "_grid", None) is None:
             times = self._timestamps
-        return np.nanargmin(np.abs(times - t))
+            if isinstance(times, UniformTimes) and len(times) > 1 and\
+               times.dt > 0:
+                self._grid = ("uniform", times.t0.magnitude.item(),
+                              times.dt.magnitude.item())
+                return self._grid
+            if hasattr(times, "units"):
+                times = times.magnitude
+            steps = np.diff(times)
+            if len(times) < 2 or not (steps > 0).all():
+                self._grid = ("unsorted",)
+            elif np.allclose(steps, steps.mean(), rtol=1e-6, atol=0.):
+                self._grid = ("uniform", times[0],
+                              (times[-1] - times[0]) / (len(times) - 1))
+            else:
+                self._grid = ("sorted",)
+        return self._grid
+
+    def _owns_data(self):
+        # Quantities wrappers make every magnitude a view, so ownership is
+        # tracked from allocation instead of read off the buffer.
+        return getattr(self, "_owned", False) and\
+               isinstance(self._data, np.ndarray) and\
+               self._data.flags.writeable
+
+    def _keep_channels(self, other):
+        other._channels, other._fingerprint = self._channels, self._fingerprint
+        return other
+
+    def _share(self, other):
+        mine, theirs = storage.source(self._data), storage.source(other._data)
+        if isinstance(mine, np.ndarray) and isinstance(theirs, np.ndarray) and\
+           np.may_share_memory(mine, theirs):
+            self._owned = False
+        return other
 
     def sort_channels(self, key):
         indices = self.channels.sort_values(key, ascending=False).index
@@ -112,6 +501,51 @@ class Signal(collections.abc.Sequence):
     def time_to_samples(self, t):
         return math.ceil(t * self.f0)
 
+    @property
+    def units(self):
+        return self._units
+
+    def _wrap(self, data):
+        if hasattr(data, "units") or self.units is None:
+            return data
+        return pq.Quantity(data, self.units)
+
+class EpochMask:
+    def __init__(self, firsts, lasts, num_samples):
+        assert len(firsts) == len(lasts)
+        self._firsts = np.asarray(firsts)
+        self._lasts = np.asarray(lasts)
+        self._num_samples = num_samples
+
+    def apply(self, sig):
+        mask = np.asarray(self)
+        return sig.fmap(lambda data: np.where(mask, np.nan_to_num(data), 0.),
+                        magnitude=True)
+
+    def __array__(self, dtype=None, copy=None):
+        samples = np.arange(self.num_samples)[:, np.newaxis]
+        mask = (samples >= self._firsts) & (samples < self._lasts)
+        return mask if dtype is None else mask.astype(dtype)
+
+    @property
+    def firsts(self):
+        return self._firsts
+
+    def __getitem__(self, trials):
+        return self.__class__(self.firsts[trials], self.lasts[trials],
+                              self.num_samples)
+
+    @property
+    def lasts(self):
+        return self._lasts
+
+    def __len__(self):
+        return len(self._firsts)
+
+    @property
+    def num_samples(self):
+        return self._num_samples
+
 class EpochedSignal(Signal):
     def __init__(self, channels: pd.DataFrame, data, dt, timestamps):
         assert len(data.shape) == 3
@@ -123,62 +557,64 @@ class EpochedSignal(Signal):
         super().__init__(channels, data, dt, timestamps)
 
     def __add__(self, sig):
-        assert self.__class__ == sig.__class__
-        assert (self.channels == sig.channels).all().all()
-        assert self.dt == sig.dt
-
-        num_samples = min(self.data.shape[1], sig.data.shape[1])
-        if not np.allclose(self.times[:num_samples], sig.times[:num_samples],
-                           atol=self.dt):
-            dt = self.dt.magnitude if hasattr(self.dt, "units") else self.dt
-            timestamps = np.arange(0, num_samples * dt, dt) * self.dt.units
-        else:
-            timestamps = self.times
-        timestamps = timestamps[:num_samples]
-
-        data = self.data[:, :num_samples] + sig.data[:, :num_samples]
-        return self.__class__(self.channels, data, self.dt, timestamps)
+        return sum_signals([self, sig])
 
-    def baseline_correct(self, start, stop):
+    def baseline_correct(self, start, stop, workers=None):
         start, stop = self.sample_at(start), self.sample_at(stop) - 1
-        def f(data):
-            return data - data[:, start:stop].mean(axis=1)[:, np.newaxis, :]
-        return self.fmap(f)
-
-    @property
-    def data(self):
-        return self._data
+        return self.fmap(functools.partial(_baseline_trials, start, stop),
+                         magnitude=True, trialwise=True, workers=workers)
 
     def downsample(self, n):
         channels = self.channels.loc[0::n]
-        data = self.data[0::n, :, :]
-        return self.__class__(channels, data, self.dt, self.times)
+        data = self._wrap(self._data[0::n, :, :])
+        return self._share(self.__class__(channels, data, self.dt,
+                                          self.times))
 
-    def epoch(self, intervals, time_shift=0.):
+    def epoch(self, intervals, time_shift=0., dtype=None, indices=None):
         assert intervals.shape == (self.num_trials, 2)
         if not hasattr(time_shift, "units"):
             time_shift = time_shift * self.dt.units
-
-        data = []
-        for trial, (start, end) in enumerate(intervals):
-            first, last = self.sample_at(start), self.sample_at(end)
-            data.append(self._data[:, first:last, trial])
-        time_length = min([trial.shape[1] for trial in data])
-        units = data[0].units
-        data = np.stack([trial[:, :time_length] for trial in data], axis=-1)
-        timestamps = np.arange(data.shape[1]) * self.dt + time_shift
-        return self.__class__(self.channels, data * units, self.dt, timestamps)
+        dtype = _resolve_dtype(dtype) or self.dtype
+
+        if indices is None:
+            indices = self.samples_at(intervals[:, 0]),\
+                      self.samples_at(intervals[:, 1])
+        firsts, lasts = indices
+        time_length = max((lasts - firsts).min(), 0)
+        if storage.is_lazy(self._data):
+            data = np.empty((self.num_channels, time_length, len(firsts)),
+                            dtype=dtype)
+            for trial, first in enumerate(firsts):
+                data[:, :, trial] = self._data[:, first:first+time_length,
+                                               trial].magnitude
+        else:
+            indices = np.arange(time_length)[:, np.newaxis] + firsts
+            data = np.take_along_axis(self._data, indices[np.newaxis], axis=1)
+            data = data.astype(dtype, copy=False)
+        timestamps = UniformTimes(time_shift, self.dt, data.shape[1])
+        result = self._keep_channels(self.__class__(
+            self._channels, self._wrap(data), self.dt, timestamps
+        ))
+        result._owned = True
+        return result
 
     def evoked(self):
-        data = self.data.magnitude.mean(-1, keepdims=True) * self.data.units
-        return EvokedSignal(self.channels, data, self.dt, self.times)
+        if storage.is_lazy(self._data):
+            data = sum(chunk.sum(-1, keepdims=True) for chunk
+                       in self.trial_chunks())
+            data = self._wrap(data / self.num_trials)
+        else:
+            data = self._wrap(self.magnitude.mean(-1, keepdims=True))
+        return self._keep_channels(EvokedSignal(self._channels, data, self.dt,
+                                                self.times))
 
     def get_data(self, channels, times, trials):
         channels, times, trials = self._data_slices(channels, times, trials)
 
         times = slice(self.sample_at(times.start),
                       self.sample_at(times.stop) + 1, times.step)
-        return self._data[channels, times, trials]
+        return self._wrap(storage.materialize(self._data[channels, times,
+                                                         trials]))
 
     def __getitem__(self, key):
         if isinstance(key, int):
@@ -188,111 +624,268 @@ class EpochedSignal(Signal):
 
         key = slice(self.sample_at(key.start), self.sample_at(key.stop),
                     key.step)
-        return self.__class__(self.channels, self.data[:, key], self.dt,
-                              self.times[key])
+        return self._share(self._keep_channels(
+            self.__class__(self._channels, self._wrap(self._data[:, key]),
+                           self.dt, self.times[key])
+        ))
+
+    def __iadd__(self, sig):
+        return self._accumulate(sig, 1)
+
+    def _accumulate(self, sig, weight):
+        timestamps, num_samples = _combined_times([self, sig])
+        data = self._data
+        shape = (sig.num_channels, num_samples) + sig._data.shape[2:]
+        if not self._owns_data() or num_samples != len(self) or\
+           np.broadcast_shapes(data.shape, shape) != data.shape or\
+           np.result_type(data.dtype, sig.dtype) != data.dtype:
+            return sum_signals([self, sig], weights=[1, weight])
+
+        _add_weighted(data, sig._magnitude_in(self.units)[:, :num_samples],
+                    weight)
+        if timestamps is not self._timestamps:
+            self._timestamps = timestamps
+            self._grid = None
+        return self
 
-    def mask_epochs(self, onsets, offsets):
-        assert len(onsets) == len(offsets)
+    def __isub__(self, sig):
+        return self._accumulate(sig, -1)
 
-        self._data = np.nan_to_num(self._data, copy=False)
-        for trial in range(len(onsets)):
-            first = self.sample_at(onsets[trial])
-            last = self.sample_at(offsets[trial])
-            self._data[:, :first, trial] *= 0
-            self._data[:, last:, trial] *= 0
+    def lazy(self, chunk_trials=16):
+        data = storage.LazyMap(self._data, self.units,
+                               chunk_trials=chunk_trials)
+        return self._share(self._keep_channels(
+            self.__class__(self._channels, data, self.dt, self.times)
+        ))
 
-    def median_filter(self, cs=3):
-        def units_medfilt(data):
-            result = scipy.ndimage.median_filter(data, size=(cs, 1, 1))
-            return result * data.units
-        return self.fmap(units_medfilt)
+    def mask_epochs(self, onsets, offsets, inplace=True):
+        assert len(onsets) == len(offsets)
+        mask = EpochMask(self.samples_at(onsets), self.samples_at(offsets),
+                         len(self))
+        if not inplace:
+            return mask
+
+        trial_bytes = self.dtype.itemsize * self.num_channels * len(self)
+        block = max(TRIAL_BLOCK_BYTES // max(trial_bytes, 1), 1)
+        if storage.is_lazy(self._data):
+            # Lazy sources are read block by block into the masked result.
+            data = np.empty(self._data.shape, dtype=self.dtype)
+            chunks = self.trial_chunks(block)
+        else:
+            data = self.magnitude
+            if not self._owns_data():
+                data = data.copy()
+            chunks = None
+        for b in range(0, self.num_trials, block):
+            trials = slice(b, b + block)
+            chunk = data[..., trials]
+            if chunks is not None:
+                chunk[...] = next(chunks)
+            np.nan_to_num(chunk, copy=False)
+            np.copyto(chunk, 0, where=~np.asarray(mask[trials]))
+        self._data = data
+        self._owned = True
+
+    def median_filter(self, cs=3, dtype=None, workers=None):
+        dtype = _resolve_dtype(dtype) or self.dtype
+        return self.fmap(functools.partial(_median_trials, cs, dtype),
+                         magnitude=True, trialwise=True, workers=workers)
 
     @property
     def num_channels(self):
-        return self.data.shape[0]
+        return self._data.shape[0]
 
     @property
     def num_trials(self):
-        return self.data.shape[2]
+        return self._data.shape[2]
 
     def pickle(self, path):
         assert os.path.isdir(path) or not os.path.exists(path)
         os.makedirs(path, exist_ok=True)
 
+        self._pickle_arrays(path)
+        self._pickle_metadata(path)
+
+    def _pickle_arrays(self, path):
         self.channels.to_csv(path + '/channels.csv')
 
         mat.savemat(path + '/epoched_signal.mat', {
-            "data": self.data.magnitude, "timestamps": self.times.magnitude
+            "data": self.magnitude, "timestamps": self.times.magnitude
         })
+
+    def _pickle_metadata(self, path):
         other = copy.copy(self)
         other._channels = other._data = other._timestamps = None
-        other._units = {"data": self.data.units, "timestamps": self.times.units}
+        other._fingerprint = None
+        other._units = {"data": self.units, "timestamps": self.times.units}
         with open(path + "/epoched_signal.pickle", mode="wb") as f:
             pickle.dump(other, f)
 
+    def save(self, group, compression="gzip", compression_opts=None,
+             chunk_channels=8, chunk_trials=16):
+        data = self.magnitude
+        chunks = (min(chunk_channels, data.shape[0]), data.shape[1],
+                  min(chunk_trials, data.shape[2]))
+        group.create_dataset("data", data=data,
+                             chunks=chunks if all(chunks) else None,
+                             compression=compression,
+                             compression_opts=compression_opts,
+                             shuffle=compression is not None)
+        group.create_dataset("timestamps", data=self.times.magnitude)
+        storage.write_frame(group, "channels", self.channels)
+
+        other = copy.copy(self)
+        other._channels = other._data = other._timestamps = None
+        other._fingerprint = None
+        other._units = {"data": self.units, "timestamps": self.times.units}
+        storage.write_object(group, "signal", other)
+
     def select_channels(self, mask):
         channels = self.channels.copy()
         if "channel" not in channels.columns:
             channels.insert(len(channels.columns), "channel",
                             list(range(len(self.channels))))
-        return self.__class__(channels.loc[mask], self.data[mask, :], self.dt,
-                              self.times)
+        data = self._wrap(self._data[_as_slice(mask, self.num_channels), :])
+        return self._share(self.__class__(channels.loc[mask], data, self.dt,
+                                          self.times))
 
     def select_trials(self, trials):
-        return self.__class__(self.channels, self.data[:, :, trials],
-                              self.dt, self.times)
+        data = self._wrap(self._data[:, :, _as_slice(trials, self.num_trials)])
+        return self._share(self._keep_channels(
+            self.__class__(self._channels, data, self.dt, self.times)
+        ))
 
     def shift_timestamps(self, offset):
-        return self.__class__(self.channels, self.data, self.dt,
-                              self.times + offset)
+        return self._share(self._keep_channels(
+            self.__class__(self._channels, self._wrap(self._data), self.dt,
+                           self.times + offset)
+        ))
 
     def __sub__(self, sig):
-        assert self.__class__ == sig.__class__
-        assert (self.channels == sig.channels).all().all()
-        assert self.dt == sig.dt
-
-        num_samples = min(self.data.shape[1], sig.data.shape[1])
-        if not np.allclose(self.times[:num_samples], sig.times[:num_samples],
-                           atol=self.dt):
-            dt = self.dt.magnitude if hasattr(self.dt, "units") else self.dt
-            timestamps = np.arange(0, num_samples * dt, dt) * self.dt.units
+        return sum_signals([self, sig], weights=[1, -1])
+
+    def trial_chunks(self, chunk_trials=16):
+        if storage.is_lazy(self._data):
+            data = self._data
+            if not isinstance(data, storage.LazyMap):
+                data = storage.LazyMap(data, self.units,
+                                       chunk_trials=chunk_trials)
+            yield from data.chunks()
         else:
-            timestamps = self.times
-        timestamps = timestamps[:num_samples]
+            data = self.magnitude
+            for c in range(0, self.num_trials, chunk_trials):
+                yield data[..., c:c+chunk_trials]
 
-        data = self.data[:, :num_samples] - sig.data[:, :num_samples]
-        return self.__class__(self.channels, data, self.dt, timestamps)
+    @classmethod
+    def load(cls, group, lazy=False, dtype=None):
+        self = storage.read_object(group, "signal")
+
+        dtype = _resolve_dtype(dtype)
+        if lazy:
+            self._data = storage.LazyQuantity(group["data"],
+                                              self._units["data"], dtype=dtype)
+        elif dtype is not None:
+            self._data = group["data"].astype(dtype)[()]
+        else:
+            self._data = group["data"][()]
+        self._timestamps = UniformTimes.from_times(
+            group["timestamps"][()] * self._units["timestamps"]
+        )
+        self.channels = storage.read_frame(group, "channels", index_col=0)
+        self._owned = not lazy
+        self._units = self._units["data"]
+        return self
 
     @classmethod
-    def unpickle(cls, path):
+    def unpickle(cls, path, lazy=False, dtype=None):
         assert os.path.isdir(path)
 
         with open(path + "/epoched_signal.pickle", mode="rb") as f:
             self = pickle.load(f)
 
-        arrays = mat.loadmat(path + '/epoched_signal.mat')
-        self._timestamps = arrays['timestamps'] * self._units["timestamps"]
-        self._data = arrays['data'] * self._units["data"]
-        self._channels = pd.read_csv(path + '/channels.csv', index_col=0)
-        del self._units
+        filename = path + '/epoched_signal.mat'
+        dtype = _resolve_dtype(dtype)
+        if lazy or dtype is not None:
+            arrays = mat.loadmat(filename, variable_names=['timestamps'])
+            self._data = storage.lazy_mat(filename, 'data', self._units["data"])
+            if dtype is not None:
+                self._data = self._data.astype(dtype)
+            if not lazy:
+                self._data = self._data.magnitude
+        else:
+            arrays = mat.loadmat(filename)
+            self._data = arrays['data']
+        self._timestamps = UniformTimes.from_times(
+            arrays['timestamps'] * self._units["timestamps"]
+        )
+        self.channels = pd.read_csv(path + '/channels.csv', index_col=0)
+        self._owned = not lazy
+        self._units = self._units["data"]
         return self
 
-def trials_ttest(sa: EpochedSignal, sb: EpochedSignal, pvalue=0.05):
+def _add_weighted(total, data, weight):
+    if weight == 1:
+        np.add(total, data, out=total)
+    elif weight == -1:
+        np.subtract(total, data, out=total)
+    else:
+        total += weight * data
+
+def _combined_times(signals):
+    first = signals[0]
+    num_samples = min(len(sig) for sig in signals)
+    timestamps = first.times
+    for sig in signals[1:]:
+        assert first.__class__ == sig.__class__
+        assert same_channels(first, sig)
+        assert first.dt == sig.dt
+        if not times_allclose(first.times[:num_samples],
+                              sig.times[:num_samples], atol=first.dt):
+            timestamps = UniformTimes(0., first.dt, num_samples)
+    if len(timestamps) != num_samples:
+        timestamps = timestamps[:num_samples]
+    return timestamps, num_samples
+
+def sum_signals(signals, weights=None):
+    assert len(signals) > 0
+    if weights is None:
+        weights = [1] * len(signals)
+    assert len(weights) == len(signals)
+    timestamps, num_samples = _combined_times(signals)
+
+    first = signals[0]
+    shape = np.broadcast_shapes(*((sig.num_channels, num_samples) +
+                                  sig._data.shape[2:] for sig in signals))
+    dtype = np.result_type(*(sig.dtype for sig in signals),
+                           *(np.min_scalar_type(w) for w in weights))
+    total = np.zeros(shape, dtype=dtype)
+    for sig, weight in zip(signals, weights):
+        data = sig._magnitude_in(first.units)[:, :num_samples]
+        _add_weighted(total, data, weight)
+    result = first._keep_channels(first.__class__(
+        first._channels, first._wrap(total), first.dt, timestamps
+    ))
+    result._owned = True
+    return result
+
+def trials_ttest(sa: EpochedSignal, sb: EpochedSignal, pvalue=0.05,
+                 chunk_trials=16):
     assert isinstance(sa, EpochedSignal)
     assert sa.__class__ == sb.__class__
-    assert (sa.channels == sb.channels).all().all()
+    assert same_channels(sa, sb)
     assert sa.dt == sb.dt
 
-    num_samples = min(sa.data.shape[1], sb.data.shape[1])
-    np.allclose(sa.times[:num_samples], sb.times[:num_samples], sa.dt, sb.dt)
+    num_samples = min(len(sa), len(sb))
     timestamps = (sa.times[:num_samples] + sb.times[:num_samples]) / 2
-    ttest = scipy.stats.ttest_ind(sa.data[:, :num_samples],
-                                  sb.data[:, :num_samples], axis=-1,
-                                  equal_var=False, keepdims=True)
-    data = sa.data[:, :num_samples].mean(axis=-1, keepdims=True) -\
-           sb.data[:, :num_samples].mean(axis=-1, keepdims=True)
-    data *= ttest.pvalue < pvalue
-    return sa.__class__(sa.channels, data, sa.dt, timestamps).evoked()
+    left, right = (moments.Moments.of(chunk[:, :num_samples] for chunk
+                                      in sig.trial_chunks(chunk_trials))
+                   for sig in (sa, sb))
+    if sb.units != sa.units:
+        right = right.scale(sb.units.rescale(sa.units).magnitude.item())
+    _, pvals = moments.welch_t_test(left, right)
+    data = (left.mean - right.mean) * (pvals < pvalue)
+    return sa._keep_channels(sa.__class__(sa._channels, sa._wrap(data), sa.dt,
+                                          timestamps)).evoked()
 
 class EvokedSignal(EpochedSignal):
     def __init__(self, channels, data, dt, timestamps):
@@ -394,19 +987,62 @@ class RawSignal(Signal):
         self._time_dim = time_dim
         super().__init__(channels, data, dt, timestamps)
 
-    def epoch(self, intervals, time_shift=0.):
+    def epoch(self, intervals, time_shift=0., view=False, dtype=None,
+              indices=None):
         assert intervals.shape[1] == 2 and intervals.shape[0] >= 1
+        if not hasattr(time_shift, "units"):
+            time_shift = time_shift * self.dt.units
 
-        trials_data = []
-        for trial, (start, end) in enumerate(intervals):
-            trials_data.append(self[start:end])
-        trials_samples = min(data.shape[1] for data in trials_data)
-        trials_data = [data[:, :trials_samples] for data in trials_data]
-        units = trials_data[0].units
-        trials_data = np.concatenate(trials_data, axis=-1) * units
-        timestamps = np.arange(trials_data.shape[1]) * self.dt + time_shift
-        return self.epoched_signal(self.channels, trials_data, self.dt,
-                                   timestamps)
+        if indices is None:
+            indices = self.samples_at(intervals[:, 0]),\
+                      self.samples_at(intervals[:, 1])
+        firsts, lasts = indices
+        trials_samples = (lasts - firsts).min()
+        trials_data = self._gather(firsts, trials_samples, view=view,
+                                   dtype=_resolve_dtype(dtype))
+        timestamps = UniformTimes(time_shift, self.dt, trials_samples)
+        result = self._keep_channels(self.epoched_signal(
+            self._channels, trials_data, self.dt, timestamps
+        ))
+        result._owned = not view
+        return result
+
+    def _gather(self, firsts, num_samples, view=False, dtype=None):
+        if isinstance(self._data, storage.LazyQuantity):
+            data = np.empty((self.num_channels, num_samples, len(firsts)),
+                            dtype=dtype or self._data.dtype)
+            for trial, first in enumerate(firsts):
+                keys = [slice(None), slice(None)]
+                keys[self._time_dim] = slice(first, first + num_samples)
+                piece = self._data[tuple(keys)].magnitude
+                data[:, :, trial] = piece.swapaxes(self._channels_dim, 0)
+            return self._wrap(data)
+
+        data = self._data
+        steps = np.diff(firsts)
+        if view and (dtype is None or dtype == data.dtype) and\
+           (len(firsts) == 1 or (steps[0] > 0 and
+                                          (steps == steps[0]).all())):
+            step = steps[0] if len(steps) else 1
+            windows = np.lib.stride_tricks.sliding_window_view(
+                data, num_samples, axis=self._time_dim
+            )
+            keys = [slice(None), slice(None)]
+            keys[self._time_dim] = slice(firsts[0], firsts[-1] + 1, step)
+            windows = windows[tuple(keys)]
+            # (channels, trials, time) or (trials, channels, time)
+            if self._channels_dim == 0:
+                data = windows.swapaxes(1, 2)
+            else:
+                data = windows.transpose(1, 2, 0)
+        else:
+            indices = np.arange(num_samples)[:, np.newaxis] + firsts
+            if self._channels_dim != 0:
+                data = data.T
+            data = np.take(data, indices, axis=1)
+            if dtype is not None:
+                data = data.astype(dtype, copy=False)
+        return self._wrap(data)
 
     def get_data(self, channels, times, trials):
         channels, times, trials = self._data_slices(channels, times, trials)
@@ -418,9 +1054,9 @@ class RawSignal(Signal):
         keys = [None, None]
         keys[self._channels_dim] = channels
         keys[self._time_dim] = times
-        data = self._data[keys[0], keys[1]]
+        data = storage.materialize(self._data[keys[0], keys[1]])
         data = data.swapaxes(self._channels_dim, 0)
-        return data[:, :, np.newaxis]
+        return self._wrap(data[:, :, np.newaxis])
 
     def __getitem__(self, key):
         return self.get_data(None, key, None)
@@ -428,3 +1064,16 @@ class RawSignal(Signal):
     @property
     def num_trials(self):
         return 1
+
+    @classmethod
+    def from_binary(cls, filename, channels: pd.DataFrame, dt, units,
+                    dtype=np.int16, gain=None, offset=0, t0=0.,
+                    channels_dim=0, time_dim=1):
+        assert {channels_dim, time_dim} == {0, 1}
+        if not hasattr(t0, "units"):
+            t0 = t0 * dt.units
+        data = storage.lazy_binary(filename, len(channels), units, dtype=dtype,
+                                   gain=gain, offset=offset,
+                                   channels_dim=channels_dim)
+        timestamps = UniformTimes(t0, dt, data.shape[time_dim])
+        return cls(channels, data, dt, timestamps, channels_dim, time_dim)
@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 
+from collections import Counter, deque
 from collections.abc import Iterable
 import copy
 import glob
 import hdf5storage as mat
+import itertools
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -17,6 +19,8 @@ from . import signal, recording
 T = TypeVar('T', bound=signal.Signal)
 
 class Statistic(Generic[T]):
+    mergeable = False
+
     def __init__(self, iid_shape, data: Optional[np.ndarray]=None):
         assert data is None or data.shape[:len(iid_shape)] == iid_shape
         self._iid_shape = iid_shape
@@ -41,6 +45,17 @@ class Statistic(Generic[T]):
     def iid_shape(self):
         return self._iid_shape
 
+    def merge(self, other):
+        raise NotImplementedError
+
+    @property
+    def offset(self):
+        return getattr(self, "_offset", 0)
+
+    @offset.setter
+    def offset(self, offset):
+        self._offset = offset
+
     def pickle(self, path):
         assert os.path.isdir(path) or not os.path.exists(path)
         os.makedirs(path, exist_ok=True)
@@ -77,17 +92,35 @@ class ChannelwiseStatistic(Statistic[T]):
     def __init__(self, channels: pd.DataFrame, iid_shape,
                  data:Optional[np.ndarray]=None):
         assert isinstance(channels, pd.DataFrame)
-        self._channels = channels
+        self.channels = channels
 
         iid_shape = (len(channels), *iid_shape)
         super().__init__(iid_shape, data=data)
 
     @property
     def channels(self):
-        return self._channels
+        return self._channels.copy()
+
+    @channels.setter
+    def channels(self, channels):
+        self._channels = channels.copy()
+        self._fingerprint = [None]
+
+    @property
+    def channels_fingerprint(self):
+        if self._fingerprint[0] is None:
+            fingerprint = signal.channels_fingerprint(self._channels)
+            self._fingerprint[0] = fingerprint
+        return self._fingerprint[0]
 
     def fmap(self, f):
-        return self.__class__(self.channels, self.iid_shape, f(self.values))
+        return self._keep_channels(self.__class__(self._channels,
+                                                  self.iid_shape,
+                                                  f(self.values)))
+
+    def _keep_channels(self, other):
+        other._channels, other._fingerprint = self._channels, self._fingerprint
+        return other
 
     def pickle(self, path):
         assert os.path.isdir(path) or not os.path.exists(path)
@@ -127,10 +160,22 @@ class ChannelwiseStatistic(Statistic[T]):
         for k in arrays:
             v = arrays[k] * self._units[k] if k in self._units else arrays[k]
             setattr(self, k, v)
-        self._channels = pd.read_csv(path + "/channels.csv", index_col=0)
+        self.channels = pd.read_csv(path + "/channels.csv", index_col=0)
         return self
 
 
+def _element_items(element):
+    if isinstance(element, recording.Sampling):
+        return element.signals.items()
+    return element.items()
+
+def _calculate_shard(summary, elements, offsets):
+    summary = copy.copy(summary)
+    summary._stats = {}
+    summary._trials = None
+    summary.calculate(elements, offsets=offsets)
+    return summary
+
 class Summary:
     def __init__(self, signal_key: Callable, statistic):
         self._signal_key = signal_key
@@ -138,22 +183,66 @@ class Summary:
         self._stats = {}
         self._trials = None
 
-    def calculate(self, elements: Iterable[dict[str, Iterable[signal.Signal]]]):
+    def _add_trials(self, trials):
+        self._trials = trials if self._trials is None else\
+                       pd.concat((self._trials, trials), axis=0,
+                                 ignore_index=True).rename_axis("trial")
+
+    def calculate(self, elements: Iterable[dict[str, Iterable[signal.Signal]]],
+                  executor=None, shards=None, chunksize=1, offsets=None):
+        if executor is not None:
+            return self._calculate_shards(iter(elements), executor,
+                                          shards or os.cpu_count(), chunksize)
         for element in elements:
             if isinstance(element, recording.Sampling):
-                items = element.signals.items
-                self._trials = element.trials if self._trials is None else\
-                               pd.concat((self._trials, element.trials), axis=0,
-                                         ignore_index=True).rename_axis("trial")
-            else:
-                items = element.items
-            for k, v in items():
+                self._add_trials(element.trials)
+            for k, v in _element_items(element):
                 key = self.signal_key(k, v)
                 if key not in self.stats:
                     self.stats[key] = self.stat(k, v)
+                    if offsets is not None:
+                        self.stats[key].offset = offsets.get(key, 0)
                 self.stats[key].update(v)
         return self.stats
 
+    def _calculate_shards(self, elements, executor, shards, chunksize):
+        # Chunks are submitted as the elements arrive, with at most shards of
+        # them in flight, and merged back in element order.
+        template = copy.copy(self)
+        template._stats, template._trials = {}, None
+        checked, counts, futures = set(), Counter(), deque()
+        for chunk in iter(lambda: list(itertools.islice(elements, chunksize)),
+                          []):
+            offsets = dict(counts)
+            for element in chunk:
+                for k, v in _element_items(element):
+                    key = self.signal_key(k, v)
+                    if key not in checked:
+                        stat = self.stats[key] if key in self.stats else\
+                               self.stat(k, v)
+                        if not stat.mergeable:
+                            raise TypeError("%s cannot be merged" %
+                                            stat.__class__.__name__)
+                        checked.add(key)
+                    counts[key] += 1
+            if len(futures) >= shards:
+                self.merge(futures.popleft().result())
+            futures.append(executor.submit(_calculate_shard, template, chunk,
+                                           offsets))
+        while futures:
+            self.merge(futures.popleft().result())
+        return self.stats
+
+    def merge(self, other):
+        for key, stat in other.stats.items():
+            if key in self.stats:
+                self.stats[key].merge(stat)
+            else:
+                self.stats[key] = stat
+        if other._trials is not None:
+            self._add_trials(other._trials)
+        return self
+
     def pickle(self, path):
         assert os.path.isdir(path) or not os.path.exists(path)
         os.makedirs(path, exist_ok=True)
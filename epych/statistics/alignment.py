@@ -38,8 +38,9 @@ class ChannelAlignment(statistic.Statistic[signal.EpochedSignal]):
         channels = sig.channels.channel if "channel" in sig.channels.columns\
                    else sig.channels.index
         result = sig.select_channels(channels.isin(range(low, high)))
-        result.channels.location = locations
-        return result.__class__(result.channels, result.data[:, :num_times],
+        channels = result.channels
+        channels.location = locations
+        return result.__class__(channels, result.data[:, :num_times],
                                 result.dt, result.times[:num_times])
 
     def apply(self, element: signal.EpochedSignal):
@@ -1,29 +1,59 @@
 #!/usr/bin/python3
 
-import copy
 import functools
 import matplotlib.pyplot as plt
 import mne
 import numpy as np
 import cv2 as cv
+import quantities as pq
 import scipy
-from typing import TypeVar
+from typing import TypeVar, Union
 
-from .. import plotting, signal, statistic
+from .. import moments, plotting, signal, statistic, storage
 
 from . import alignment
 
 T = TypeVar('T', bound=signal.EpochedSignal)
 
+def _accumulator_dtype(dtype):
+    return signal._resolve_dtype(dtype) or np.dtype(np.float64)
+
+def _compensated_add(total, compensation, values):
+    summed = total + values
+    compensation += np.where(np.abs(total) >= np.abs(values),
+                             (total - summed) + values,
+                             (values - summed) + total)
+    total[...] = summed
+
+def _add_channels(left, right):
+    if left is None or right is None:
+        return right if left is None else left
+    left = left.copy()
+    for column in left.columns:
+        if left[column].values.dtype == np.int64:
+            left[column] += right[column]
+    return left
+
+def _add_times(left, right):
+    if left is None or right is None:
+        return right if left is None else left
+    return left + right.rescale(left.units)
+
 class GrandConcatenation(statistic.Statistic[T]):
-    def __init__(self, alignment: alignment.LaminarAlignment, data=None):
+    MERGE_TRIALS = 64
+    mergeable = True
+
+    def __init__(self, alignment: alignment.LaminarAlignment, data=None,
+                 dtype=None, directory=None):
         super().__init__((alignment.num_channels, alignment.num_times),
                          data=data)
         self._alignment = alignment
         self._dt = None
+        self._dtype = _accumulator_dtype(dtype)
+        self._directory = directory
         if data is None:
             self._data = {"channels": None, "k": 0, "cat": None,
-                          "timestamps": np.zeros(self.iid_shape[1])}
+                          "timestamps": None}
         self._signal_class = None
 
     @property
@@ -31,40 +61,73 @@ class GrandConcatenation(statistic.Statistic[T]):
         return self._alignment
 
     def apply(self, element: T):
-        element = self.alignment.align(self.data["k"], element)
+        element = self.alignment.align(self.offset + self.data["k"], element)
         assert len(element.channels) == self.num_channels
-        assert element.data.shape[0] == self.num_channels
-        data = element.data
-        if self.num_times < element.data.shape[1]:
-            data = data[:, :self.num_times, :]
-        running = copy.deepcopy(self.data)
-
-        channels = element.channels.reset_index(drop=True)
+        assert element.num_channels == self.num_channels
+        running = self.data
+
+        assert hasattr(element._dt, "units")
+        units = running["units"] if "units" in running else\
+                getattr(running["cat"], "units", element.units)
+        data = element._magnitude_in(units)[:, :self.num_times]
+        channels = _add_channels(running["channels"],
+                                 element.channels.reset_index(drop=True))
+        times = _add_times(running["timestamps"],
+                           element.times[:self.num_times])
+
+        self._cat(element.units).append(data)
         if running["channels"] is None:
-            running["channels"] = channels
             self._dt = element._dt
             self._signal_class = element.__class__
-        else:
-            for column in running["channels"].columns:
-                if running["channels"][column].values.dtype == np.int64:
-                    running["channels"][column] += channels[column]
-        assert hasattr(self._dt, "units")
-
+        running["channels"] = channels
         running["k"] += 1
-        if running["cat"] is None:
-            running["cat"] = data
-        else:
-            data = data.rescale(running["cat"].units)
-            running["cat"] = np.concatenate((running["cat"], data), axis=-1) *\
-                             data.units
-        times = element.times[:self.num_times]
-        if not hasattr(running["timestamps"], "units"):
-            running["timestamps"] = running["timestamps"] * times.units
-        else:
-            times = times.rescale(running["timestamps"].units)
-        running["timestamps"] += times
+        running["timestamps"] = times
         return running
 
+    def _cat(self, units):
+        cat = self.data["cat"]
+        if isinstance(cat, storage.TrialBuffer):
+            return cat
+        buffer = storage.TrialBuffer(self.iid_shape, self.dtype,
+                                     directory=self.directory)
+        if cat is not None:
+            units = cat.units
+            buffer.append(cat.magnitude)
+        self.data["cat"], self.data["units"] = buffer, units
+        return buffer
+
+    def close(self):
+        if isinstance(self.data["cat"], storage.TrialBuffer):
+            self.data["cat"].close()
+
+    @property
+    def directory(self):
+        return getattr(self, "_directory", None)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def merge(self, other):
+        if other.data["k"] == 0:
+            return self
+        if self._signal_class is None:
+            self._dt, self._signal_class = other._dt, other._signal_class
+        running = self.data
+        running["channels"] = _add_channels(running["channels"],
+                                            other.data["channels"])
+        running["k"] += other.data["k"]
+        trials = other._cat(None).view()
+        cat = self._cat(other.data["units"])
+        scale = other.data["units"].rescale(running["units"]).magnitude.item()
+        for c in range(0, trials.shape[-1], self.MERGE_TRIALS):
+            block = trials[..., c:c+self.MERGE_TRIALS]
+            cat.append(block if scale == 1 else block * scale)
+        other.close()
+        running["timestamps"] = _add_times(running["timestamps"],
+                                           other.data["timestamps"])
+        return self
+
     @property
     def num_channels(self):
         return self.iid_shape[0]
@@ -74,23 +137,32 @@ class GrandConcatenation(statistic.Statistic[T]):
         return self.iid_shape[1]
 
     def result(self):
+        # With a directory the data maps this statistic's spill file, which
+        # it deletes on close() or when collected; merge() closes its source.
+        data = pq.Quantity(self._cat(None).view(), self.data["units"])
         times = self.data["timestamps"] / self.data["k"]
         channels = self.data["channels"].copy()
         for column in channels.columns:
             if channels[column].values.dtype == np.int64:
                 channels[column] //= self.data["k"]
-        return self._signal_class(channels, self.data["cat"], self._dt, times)
+        return self._signal_class(channels, data, self._dt, times)
 
 class GrandAverage(statistic.Statistic[T]):
-    def __init__(self, alignment: alignment.LaminarAlignment, data=None):
+    mergeable = True
+
+    def __init__(self, alignment: alignment.LaminarAlignment, data=None,
+                 dtype=None):
         super().__init__((alignment.num_channels, alignment.num_times),
                          data=data)
         self._alignment = alignment
         self._dt = None
+        self._dtype = _accumulator_dtype(dtype)
         if data is None:
             self._data = {"channels": None, "k": 0, "n": 0,
-                          "sum": np.zeros((*self.iid_shape, 1)),
-                          "timestamps": np.zeros(self.iid_shape[1])}
+                          "sum": np.zeros((*self.iid_shape, 1), self.dtype),
+                          "compensation": np.zeros((*self.iid_shape, 1),
+                                                   self.dtype),
+                          "timestamps": None}
         self._signal_class = None
 
     @property
@@ -98,28 +170,32 @@ class GrandAverage(statistic.Statistic[T]):
         return self._alignment
 
     def apply(self, element: T):
-        element = self.alignment.align(self.data["k"], element)
+        element = self.alignment.align(self.offset + self.data["k"], element)
         assert len(element.channels) == self.num_channels
-        assert element.data.shape[0] == self.num_channels
-        data = element.data
-        if self.num_times < element.data.shape[1]:
-            data = data[:, :self.num_times, :]
-        running = copy.deepcopy(self.data)
+        assert element.num_channels == self.num_channels
+        running = self.data
+
+        units = getattr(running["sum"], "units", element.units)
+        data = element._magnitude_in(units)[:, :self.num_times]
+        data = data.sum(axis=-1, keepdims=True, dtype=running["sum"].dtype)
+        channels = _add_channels(running["channels"],
+                                 element.channels.reset_index(drop=True))
+        times = _add_times(running["timestamps"],
+                           element.times[:self.num_times])
 
-        channels = element.channels.reset_index(drop=True)
         if running["channels"] is None:
-            running["channels"] = channels
             self._dt = element._dt
             self._signal_class = element.__class__
-        else:
-            for column in running["channels"].columns:
-                if running["channels"][column].values.dtype == np.int64:
-                    running["channels"][column] += channels[column]
-
+        if not hasattr(running["sum"], "units"):
+            running["sum"] = pq.Quantity(running["sum"], units)
+        sums = running["sum"].magnitude
+        if "compensation" not in running:
+            running["compensation"] = np.zeros_like(sums)
+        _compensated_add(sums, running["compensation"], data)
+        running["channels"] = channels
         running["k"] += 1
         running["n"] += element.num_trials
-        running["sum"] += data.sum(axis=-1, keepdims=True)
-        running["timestamps"] += element.times[:self.num_times]
+        running["timestamps"] = times
         return running
 
     def heatmap(self, ax=None, fig=None, title=None, vmin=None, vmax=None,
@@ -139,6 +215,35 @@ class GrandAverage(statistic.Statistic[T]):
         xticks = ["%0.2f" % t for t in xticks]
         ax.set_xticks(xtick_locs, xticks)
 
+    def merge(self, other):
+        if other.data["k"] == 0:
+            return self
+        if self._signal_class is None:
+            self._dt, self._signal_class = other._dt, other._signal_class
+        running = self.data
+        running["channels"] = _add_channels(running["channels"],
+                                            other.data["channels"])
+        running["k"] += other.data["k"]
+        running["n"] += other.data["n"]
+        if not hasattr(running["sum"], "units"):
+            running["sum"] = pq.Quantity(running["sum"],
+                                         other.data["sum"].units)
+        sums = running["sum"].magnitude
+        scale = other.data["sum"].units.rescale(running["sum"].units)
+        scale = scale.magnitude.item()
+        if "compensation" not in running:
+            running["compensation"] = np.zeros_like(sums)
+        _compensated_add(sums, running["compensation"],
+                         other.data["sum"].magnitude * scale)
+        running["compensation"] += other.data.get("compensation", 0.) * scale
+        running["timestamps"] = _add_times(running["timestamps"],
+                                           other.data["timestamps"])
+        return self
+
+    @property
+    def dtype(self):
+        return self._dtype
+
     @property
     def num_channels(self):
         return self.iid_shape[0]
@@ -151,7 +256,8 @@ class GrandAverage(statistic.Statistic[T]):
         return self.result().plot(**kwargs)
 
     def result(self):
-        data = self.data["sum"] / self.data["n"]
+        data = self.data["sum"].magnitude + self.data.get("compensation", 0.)
+        data = pq.Quantity(data / self.data["n"], self.data["sum"].units)
         times = self.data["timestamps"] / self.data["k"]
         channels = self.data["channels"].copy()
         for column in channels.columns:
@@ -160,44 +266,228 @@ class GrandAverage(statistic.Statistic[T]):
         return self._signal_class(channels, data, self._dt, times).evoked()
 
 class GrandVariance(statistic.Statistic[T]):
+    mergeable = True
+
     def __init__(self, alignment: alignment.ChannelAlignment,
-                 mean: signal.EvokedSignal, data=None):
+                 mean: signal.EvokedSignal, data=None, dtype=None):
         super().__init__((alignment.num_channels, alignment.num_times),
                          data=data)
         self._alignment = alignment
+        self._dtype = _accumulator_dtype(dtype)
         self._mean = mean
         if data is None:
-            self._data = {"diffs": np.zeros((*self.iid_shape, 1)), "k": 0,
-                          "n": 0}
+            self._data = {"diffs": np.zeros((*self.iid_shape, 1), self.dtype),
+                          "compensation": np.zeros((*self.iid_shape, 1),
+                                                   self.dtype),
+                          "k": 0, "n": 0}
 
     @property
     def alignment(self):
         return self._alignment
 
     def apply(self, element: T):
-        element = self.alignment.align(self.data["k"], element)
+        element = self.alignment.align(self.offset + self.data["k"], element)
         assert len(element.channels) == self.alignment.num_channels
-        assert element.data.shape[0] == self.alignment.num_channels
-        data = element.data
-        if self.alignment.num_times < element.data.shape[1]:
-            data = data[:, :self.alignment.num_times, :]
-        running = copy.deepcopy(self.data)
-
-        running["diffs"] += ((data - self.mean.data) ** 2).sum(axis=-1,
-                                                               keepdims=True)
+        assert element.num_channels == self.alignment.num_channels
+        running = self.data
+
+        data = element._magnitude_in(self.mean.units)
+        data = data[:, :self.alignment.num_times]
+        squares = ((data - self.mean.magnitude) ** 2).sum(
+            axis=-1, keepdims=True, dtype=running["diffs"].dtype
+        )
+
+        if not hasattr(running["diffs"], "units"):
+            running["diffs"] = pq.Quantity(running["diffs"],
+                                           self.mean.units ** 2)
+        diffs = running["diffs"].magnitude
+        if "compensation" not in running:
+            running["compensation"] = np.zeros_like(diffs)
+        _compensated_add(diffs, running["compensation"], squares)
         running["k"] += 1
         running["n"] += element.num_trials
         return running
 
+    @property
+    def dtype(self):
+        return self._dtype
+
     @property
     def mean(self):
         return self._mean
 
+    def merge(self, other):
+        if other.data["k"] == 0:
+            return self
+        running = self.data
+        if not hasattr(running["diffs"], "units"):
+            running["diffs"] = pq.Quantity(running["diffs"],
+                                           self.mean.units ** 2)
+        diffs = running["diffs"].magnitude
+        scale = other.data["diffs"].units.rescale(running["diffs"].units)
+        scale = scale.magnitude.item()
+        if "compensation" not in running:
+            running["compensation"] = np.zeros_like(diffs)
+        _compensated_add(diffs, running["compensation"],
+                         other.data["diffs"].magnitude * scale)
+        running["compensation"] += other.data.get("compensation", 0.) * scale
+        running["k"] += other.data["k"]
+        running["n"] += other.data["n"]
+        return self
+
     def result(self):
-        variance = self.data["diffs"] / (self.data["n"] - 1)
+        diffs = self.data["diffs"].magnitude + self.data.get("compensation", 0.)
+        variance = pq.Quantity(diffs / (self.data["n"] - 1),
+                               self.data["diffs"].units)
         return self.mean.__class__(self.mean.channels, variance, self.mean._dt,
                                    self.mean.times)
 
+class _GrandMomentsBase(statistic.Statistic[T]):
+    def __init__(self, alignment: alignment.LaminarAlignment, data=None,
+                 dtype=None):
+        super().__init__((alignment.num_channels, alignment.num_times),
+                         data=data)
+        self._alignment = alignment
+        self._dt = None
+        self._dtype = _accumulator_dtype(dtype)
+        if data is None:
+            self._data = {"channels": None, "k": 0,
+                          "moments": moments.Moments(), "timestamps": None,
+                          "units": None}
+        self._signal_class = None
+
+    def _accumulate(self, data):
+        self.data["moments"] = self.data["moments"].update(data)
+
+    @property
+    def alignment(self):
+        return self._alignment
+
+    def apply(self, element: T):
+        element = self.alignment.align(self.offset + self.data["k"], element)
+        assert len(element.channels) == self.num_channels
+        assert element.num_channels == self.num_channels
+        running = self.data
+
+        units = element.units if running["units"] is None else\
+                running["units"]
+        data = element._magnitude_in(units)[:, :self.num_times]
+        channels = _add_channels(running["channels"],
+                                 element.channels.reset_index(drop=True))
+        times = _add_times(running["timestamps"],
+                           element.times[:self.num_times])
+
+        self._accumulate(data.astype(self.dtype, copy=False))
+        if running["channels"] is None:
+            self._dt = element._dt
+            self._signal_class = element.__class__
+        running["channels"] = channels
+        running["k"] += 1
+        running["timestamps"] = times
+        running["units"] = units
+        return running
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def moments(self):
+        return self.data["moments"]
+
+    @property
+    def n(self):
+        return self.moments.count
+
+    @property
+    def num_channels(self):
+        return self.iid_shape[0]
+
+    @property
+    def num_times(self):
+        return self.iid_shape[1]
+
+    def _signal(self, data, units):
+        times = self.data["timestamps"] / self.data["k"]
+        channels = self.data["channels"].copy()
+        for column in channels.columns:
+            if channels[column].values.dtype == np.int64:
+                channels[column] //= self.data["k"]
+        return self._signal_class(channels, pq.Quantity(data, units), self._dt,
+                                  times).evoked()
+
+    def result(self):
+        return self._signal(self.moments.mean, self.data["units"])
+
+    def variance(self, ddof=1):
+        return self._signal(self.moments.variance(ddof),
+                            self.data["units"] ** 2)
+
+class GrandMoments(_GrandMomentsBase[T]):
+    mergeable = True
+
+    def merge(self, other):
+        if other.data["k"] == 0:
+            return self
+        if self._signal_class is None:
+            self._dt, self._signal_class = other._dt, other._signal_class
+        running = self.data
+        if running["units"] is None:
+            running["units"] = other.data["units"]
+        scale = other.data["units"].rescale(running["units"]).magnitude.item()
+        running["channels"] = _add_channels(running["channels"],
+                                            other.data["channels"])
+        running["k"] += other.data["k"]
+        running["moments"] = running["moments"].merge(
+            other.moments if scale == 1 else other.moments.scale(scale)
+        )
+        running["timestamps"] = _add_times(running["timestamps"],
+                                           other.data["timestamps"])
+        return self
+
+class GrandHigherMoments(GrandMoments):
+    def __init__(self, alignment: alignment.LaminarAlignment, data=None,
+                 dtype=None):
+        super().__init__(alignment, data=data, dtype=dtype)
+        if data is None:
+            self.data["moments"] = moments.HigherMoments()
+
+    def kurtosis(self):
+        return self._signal(self.moments.kurtosis(), pq.dimensionless)
+
+    def skewness(self):
+        return self._signal(self.moments.skewness(), pq.dimensionless)
+
+# P-squared sketches cannot be merged, so quantiles share the accumulation of
+# GrandMoments but not its merge.
+class GrandQuantiles(_GrandMomentsBase[T]):
+    def __init__(self, alignment: alignment.LaminarAlignment, quantiles=(0.5,),
+                 data=None, dtype=None):
+        super().__init__(alignment, data=data, dtype=dtype)
+        if data is None:
+            quantiles = sorted(set(quantiles) | {0.5})
+            self.data["sketch"] = moments.P2Quantiles(quantiles, self.dtype)
+
+    def _accumulate(self, data):
+        super()._accumulate(data)
+        self.data["sketch"].update(data)
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def quantile(self, q):
+        index = np.flatnonzero(np.isclose(self.quantiles, q))
+        assert len(index) == 1
+        return self._signal(self.data["sketch"].result()[..., index],
+                            self.data["units"])
+
+    @property
+    def quantiles(self):
+        return self.data["sketch"].quantiles
+
+    def result(self):
+        return self.median()
+
 class GrandNonparametricClusterTest(statistic.Statistic[T]):
     def __init__(self, alignment: alignment.LaminarAlignment, alpha=0.05,
                  data=None, partitions=1000):
@@ -221,7 +511,7 @@ class GrandNonparametricClusterTest(statistic.Statistic[T]):
     def apply(self, element: tuple[T, T]):
         assert self.data["left"] is None and self.data["right"] is None
         assert element[0].dt == element[1].dt
-        assert (element[0].channels == element[1].channels).all().all()
+        assert signal.same_channels(element[0], element[1])
 
         return {"left": element[0], "right": element[1]}
 
@@ -275,17 +565,16 @@ class GrandNonparametricClusterTest(statistic.Statistic[T]):
             }
         return self._result
 
-def t_stats(ln, lmean, lvar, rn, rmean, rvar):
-    l_stderr, r_stderr = lvar / ln, rvar / rn
-    ts = (lmean - rmean) / np.sqrt(l_stderr + r_stderr)
-    dfs = (l_stderr + r_stderr) ** 2
-    dfs /= l_stderr ** 2 / (ln - 1) + r_stderr ** 2 / (rn - 1)
-    pvals = scipy.special.stdtr(dfs, -np.abs(ts)) * 2
-    return ts, pvals
+t_stats = moments.t_stats
 
-def t_test(left: GrandVariance, right: GrandVariance):
+def t_test(left: Union[GrandVariance, GrandMoments],
+           right: Union[GrandVariance, GrandMoments]):
     assert left.iid_shape == right.iid_shape
-    k = n = 0
+    assert isinstance(left, GrandMoments) == isinstance(right, GrandMoments)
+    if isinstance(left, GrandMoments):
+        scale = right.data["units"].rescale(left.data["units"]).magnitude
+        return moments.welch_t_test(left.moments,
+                                    right.moments.scale(scale.item()))
 
     return t_stats(left.data["n"], left.mean.data.magnitude,
                    left.result().data.magnitude, right.data["n"],
@@ -18,10 +18,14 @@ ALPHA_BETA_BAND = (8. * pq.Hz, 30. * pq.Hz)
 GAMMA_BAND = (50. * pq.Hz, 150. * pq.Hz)
 
 class PowerSpectrum(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
-    def __init__(self, df, channels, f0, fmax=150, taper=None, data=None):
+    mergeable = True
+
+    def __init__(self, df, channels, f0, fmax=150, taper=None, data=None,
+                 dtype=None):
         if not hasattr(fmax, "units"):
             fmax = np.array(fmax) * pq.Hz
         self._df = df.rescale("Hz")
+        self._dtype = signal._resolve_dtype(dtype)
         self._f0 = f0.rescale("Hz")
         self._freqs = np.arange(0, fmax.item(), df.item())
         self._freqs = (self._freqs + df.item()) * df.units
@@ -29,7 +33,7 @@ class PowerSpectrum(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
         super().__init__(channels, (int((fmax / df).item()),), data=data)
 
     def apply(self, element: signal.EpochedSignal):
-        assert (element.channels == self.channels).all().all()
+        assert signal.same_channels(element, self)
         assert element.df == self.df
         assert element.f0 >= self.f0
 
@@ -53,6 +57,8 @@ class PowerSpectrum(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
         cfg.tapsmofrq = 4
         cfg.toi = "all"
         psd = np.stack(spy.freqanalysis(cfg, data).show(), axis=-1)
+        if self.dtype is not None:
+            psd = psd.astype(self.dtype, copy=False)
 
         if self.data is None:
             return np.moveaxis(psd, 0, 1)
@@ -77,12 +83,18 @@ class PowerSpectrum(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
     def dt(self):
         return (1. / self.f0).rescale('s')
 
+    @property
+    def dtype(self):
+        return self._dtype
+
     def evoked(self):
         return self.fmap(lambda vals: vals.mean(axis=-1))
 
     def fmap(self, f):
-        return self.__class__(self.df, self.channels, self.f0, fmax=self.fmax,
-                              data=f(self.data))
+        return self._keep_channels(self.__class__(
+            self.df, self._channels, self.f0, fmax=self.fmax,
+            data=f(self.data), dtype=self.dtype
+        ))
 
     @property
     def f0(self):
@@ -108,6 +120,15 @@ class PowerSpectrum(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
                          vmin=0., vmax=self.data.max())
         ax.set_xlim(left=fbottom, right=ftop)
 
+    def merge(self, other):
+        assert signal.same_channels(self, other)
+        assert other.df == self.df
+        if self.data is None:
+            self._data = other.data
+        elif other.data is not None:
+            self._data = np.concatenate((self.data, other.data), axis=-1)
+        return self
+
     def plot_channels(self, stat, ax=None, xlims=None):
         if ax is None:
             ax = plt.gca()
@@ -127,11 +148,12 @@ class PowerSpectrum(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
 
 class Spectrogram(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
     def __init__(self, df, channels, f0, chunk_trials=4, fmax=150, taper=None,
-                 data=None):
+                 data=None, dtype=None):
         if not hasattr(fmax, "units"):
             fmax = np.array(fmax) * pq.Hz
         self._chunk_trials = chunk_trials
         self._df = df.rescale("Hz")
+        self._dtype = signal._resolve_dtype(dtype)
         self._f0 = f0.rescale("Hz")
         self._freqs = np.arange(0, fmax.item(), df.item())
         self._freqs = (self._freqs + df.item()) * df.units
@@ -140,7 +162,7 @@ class Spectrogram(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
         super().__init__(channels, (int((fmax / df).item()),), data=data)
 
     def apply(self, element: signal.EpochedSignal):
-        assert (element.channels == self.channels).all().all()
+        assert signal.same_channels(element, self)
         assert element.df == self.df
         assert element.f0 >= self.f0
 
@@ -198,9 +220,15 @@ class Spectrogram(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
     def dt(self):
         return (1. / self.f0).rescale('s')
 
+    @property
+    def dtype(self):
+        return self._dtype
+
     def fmap(self, f):
-        return self.__class__(self.df, self.channels, self.f0, fmax=self.fmax,
-                              data=f(self.data))
+        return self._keep_channels(self.__class__(
+            self.df, self._channels, self.f0, fmax=self.fmax,
+            data=f(self.data), dtype=self.dtype
+        ))
 
     @property
     def f0(self):
@@ -250,6 +278,8 @@ class Spectrogram(statistic.ChannelwiseStatistic[signal.EpochedSignal]):
                 else:
                     tfrs = tfrs[:, :, :, np.newaxis]
                 tfrs = np.moveaxis(tfrs, 2, 0)
+                if self.dtype is not None:
+                    tfrs = tfrs.astype(self.dtype, copy=False)
                 assert len(tfrs.shape) == 4
                 tfr_data.append(tfrs)
         tfrs = np.concatenate(tfr_data, axis=-1).swapaxes(0, -1)
@@ -0,0 +1,427 @@
+#!/usr/bin/python3
+
+import h5py
+import io
+from multiprocessing import shared_memory
+import numpy as np
+import operator
+import os
+import pandas as pd
+import pickle
+import quantities as pq
+import tempfile
+import weakref
+
+def _select(selection, key):
+    if isinstance(key, (int, np.integer)):
+        return int(np.asarray(selection)[key])
+    if isinstance(key, slice):
+        return selection[key]
+    key = np.asarray(key)
+    if key.dtype == bool:
+        assert len(key) == len(selection)
+        key = np.flatnonzero(key)
+    return np.asarray(selection)[key]
+
+def _compose(selection, key):
+    if not isinstance(key, tuple):
+        key = (key,)
+    axes = [i for i, s in enumerate(selection) if not isinstance(s, int)]
+    if any(k is Ellipsis for k in key):
+        e = next(i for i, k in enumerate(key) if k is Ellipsis)
+        fill = (slice(None),) * (len(axes) - len(key) + 1)
+        key = key[:e] + fill + key[e+1:]
+    assert len(key) <= len(axes)
+
+    selection = list(selection)
+    for axis, k in zip(axes, key):
+        selection[axis] = _select(selection[axis], k)
+    return selection
+
+class LazyQuantity:
+    def __init__(self, dataset, units, axes=None, selection=None, scale=None,
+                 dtype=None):
+        if axes is None:
+            axes = tuple(range(len(dataset.shape)))
+        if selection is None:
+            selection = tuple(range(dataset.shape[a]) for a in axes)
+        assert len(axes) == len(selection) == len(dataset.shape)
+
+        self._dataset = dataset
+        self._units = units
+        self._axes = tuple(axes)
+        self._dtype = None if dtype is None else np.dtype(dtype)
+        self._scale = scale
+        self._selection = tuple(selection)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.magnitude
+        return data if dtype is None else data.astype(dtype)
+
+    def astype(self, dtype, copy=True):
+        return self.__class__(self._dataset, self._units, self._axes,
+                              self._selection, self._scale, dtype)
+
+    @property
+    def dtype(self):
+        if self._dtype is not None:
+            return self._dtype
+        if self._scale is None:
+            return self._dataset.dtype
+        return np.result_type(self._dataset.dtype, self._scale)
+
+    def __getitem__(self, key):
+        selection = _compose(self._selection, key)
+        return self.__class__(self._dataset, self._units, self._axes,
+                              selection, self._scale, self._dtype)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self._dataset, np.memmap):
+            state["_dataset"] = ("memmap", self._dataset.filename,
+                                 self._dataset.dtype, self._dataset.shape,
+                                 self._dataset.offset)
+        elif isinstance(self._dataset, h5py.Dataset):
+            state["_dataset"] = ("hdf5", self._dataset.file.filename,
+                                 self._dataset.name)
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def magnitude(self):
+        return self.read().magnitude
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def read(self):
+        key = [slice(None)] * len(self._axes)
+        post = [slice(None)] * len(self._axes)
+        for s, axis in zip(self._selection, self._axes):
+            if isinstance(s, int):
+                key[axis] = s
+            elif isinstance(s, range) and len(s) and s.step > 0:
+                key[axis] = slice(s.start, s[-1] + 1, s.step)
+            else:
+                s = np.asarray(s)
+                lo = s.min() if len(s) else 0
+                hi = s.max() + 1 if len(s) else 0
+                key[axis], post[axis] = slice(lo, hi), s - lo
+        dataset = self._dataset
+        if self._dtype is not None and self._scale is None and\
+           isinstance(dataset, h5py.Dataset):
+            dataset = dataset.astype(self._dtype)
+        data = np.asarray(dataset[tuple(key)])
+
+        kept = [axis for axis, s in zip(self._axes, self._selection)
+                if not isinstance(s, int)]
+        stored = sorted(kept)
+        for i, axis in enumerate(stored):
+            if not isinstance(post[axis], slice):
+                data = np.take(data, post[axis], axis=i)
+        data = np.transpose(data, [stored.index(axis) for axis in kept])
+        if self._scale is not None:
+            data = data * self._scale
+        if self._dtype is not None:
+            data = data.astype(self._dtype, copy=False)
+        return pq.Quantity(data, self.units)
+
+    def rescale(self, units):
+        return self.read().rescale(units)
+
+    def __setstate__(self, state):
+        dataset = state["_dataset"]
+        if isinstance(dataset, tuple) and dataset[0] == "memmap":
+            _, filename, dtype, shape, offset = dataset
+            dataset = np.memmap(filename, dtype=dtype, mode="r", shape=shape,
+                                offset=offset)
+        elif isinstance(dataset, tuple) and dataset[0] == "hdf5":
+            dataset = h5py.File(dataset[1], mode="r")[dataset[2]]
+        state["_dataset"] = dataset
+        self.__dict__.update(state)
+
+    @property
+    def shape(self):
+        return tuple(len(s) for s in self._selection if not isinstance(s, int))
+
+    @property
+    def units(self):
+        return self._units
+
+def _key(selection):
+    if isinstance(selection, range) and len(selection) and selection.step > 0:
+        return slice(selection.start, selection[-1] + 1, selection.step)
+    return selection if isinstance(selection, int) else np.asarray(selection)
+
+def _take(data, selection, axis):
+    key = [slice(None)] * data.ndim
+    key[axis] = _key(selection)
+    return data[tuple(key)]
+
+class LazyMap:
+    def __init__(self, source, units, funcs=(), selection=None,
+                 chunk_trials=16):
+        assert len(source.shape) == 3
+        if selection is None:
+            selection = tuple(range(n) for n in source.shape)
+        assert len(selection) == 3
+
+        self._chunk_trials = chunk_trials
+        self._dtype = None
+        self._funcs = tuple(funcs)
+        self._selection = tuple(selection)
+        self._source = source
+        self._units = units
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.magnitude
+        return data if dtype is None else data.astype(dtype)
+
+    def astype(self, dtype, copy=True):
+        return self.map(operator.methodcaller("astype", dtype, copy=False))
+
+    @property
+    def chunk_trials(self):
+        return self._chunk_trials
+
+    def chunks(self):
+        channels, times, trials = self._selection
+        trials = np.atleast_1d(np.asarray(trials))
+        for c in range(0, len(trials), self.chunk_trials):
+            block = trials[c:c+self.chunk_trials]
+            if len(block) and (np.diff(block) == 1).all():
+                block = slice(block[0], block[-1] + 1)
+            data = materialize(self._source[:, :, block])
+            data = getattr(data, "magnitude", data)
+            for f in self._funcs:
+                data = f(data)
+            yield _take(_take(data, times, 1), channels, 0)
+
+    @property
+    def dtype(self):
+        if self._dtype is None:
+            if self._funcs and self._source.shape[2]:
+                data = materialize(self._source[:, :, 0:1])
+                for f in self._funcs:
+                    data = f(getattr(data, "magnitude", data))
+                self._dtype = data.dtype
+            else:
+                self._dtype = np.dtype(self._source.dtype)
+        return self._dtype
+
+    def __getitem__(self, key):
+        selection = _compose(self._selection, key)
+        other = self.__class__(self._source, self._units, self._funcs,
+                               selection, self._chunk_trials)
+        other._dtype = self._dtype
+        return other
+
+    def __len__(self):
+        return self.shape[0]
+
+    def map(self, f):
+        channels, times, _ = self._selection
+        if all(isinstance(s, range) and s == range(n) for s, n
+               in zip((channels, times), self._source.shape[:2])):
+            return self.__class__(self._source, self._units,
+                                  self._funcs + (f,), self._selection,
+                                  self._chunk_trials)
+        return self.__class__(self, self._units, (f,),
+                              chunk_trials=self._chunk_trials)
+
+    @property
+    def magnitude(self):
+        return self.read().magnitude
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def read(self):
+        trials = self._selection[2]
+        shape = self.shape if not isinstance(trials, int) else\
+                self.shape + (1,)
+        data = np.empty(shape, dtype=self.dtype)
+        c = 0
+        for chunk in self.chunks():
+            data[..., c:c+chunk.shape[-1]] = chunk
+            c += chunk.shape[-1]
+        if isinstance(trials, int):
+            data = data[..., 0]
+        return pq.Quantity(data, self.units)
+
+    def rescale(self, units):
+        return self.read().rescale(units)
+
+    @property
+    def shape(self):
+        return tuple(len(s) for s in self._selection if not isinstance(s, int))
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def units(self):
+        return self._units
+
+class SharedArray:
+    def __init__(self, array):
+        self._dtype = array.dtype
+        self._owner = True
+        self._shape = array.shape
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=max(array.nbytes, 1))
+        self.array()[...] = array
+
+    def array(self):
+        return np.ndarray(self._shape, dtype=self._dtype, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return {"_dtype": self._dtype, "_name": self._shm.name,
+                "_shape": self._shape}
+
+    def release(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __setstate__(self, state):
+        self._dtype = state["_dtype"]
+        self._owner = False
+        self._shape = state["_shape"]
+        self._shm = shared_memory.SharedMemory(name=state["_name"])
+
+def _unlink(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+class TrialBuffer:
+    def __init__(self, shape, dtype=np.float64, directory=None, capacity=16):
+        self._dtype = np.dtype(dtype)
+        self._finalizer = None
+        self._length = 0
+        self._path = None
+        self._shape = tuple(shape)
+        if directory is None:
+            self._data = np.empty((*self._shape, capacity), dtype=self._dtype)
+        else:
+            # Every buffer spills to its own new file, never an existing one,
+            # and deletes it on close() or once it is garbage collected.
+            fd, self._path = tempfile.mkstemp(suffix=".trials", dir=directory)
+            os.close(fd)
+            self._data = None
+            self._finalizer = weakref.finalize(self, _unlink, self._path)
+
+    def append(self, block):
+        assert block.shape[:-1] == self._shape
+        num_trials = block.shape[-1]
+        if self._path is None:
+            if self._length + num_trials > self._data.shape[-1]:
+                capacity = max(2 * self._data.shape[-1],
+                               self._length + num_trials)
+                data = np.empty((*self._shape, capacity), dtype=self._dtype)
+                data[..., :self._length] = self._data[..., :self._length]
+                self._data = data
+            self._data[..., self._length:self._length+num_trials] = block
+        else:
+            with open(self._path, mode="ab") as f:
+                np.ascontiguousarray(np.moveaxis(block, -1, 0),
+                                     dtype=self._dtype).tofile(f)
+        self._length += num_trials
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+        self._data = None
+        self._length = 0
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        # Pickling hands the spill file over to the unpickled copy.
+        state = self.__dict__.copy()
+        state["_finalizer"] = None
+        if self._path is None:
+            state["_data"] = self.view().copy()
+        elif self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
+        return state
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def path(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._path is not None and os.path.exists(self._path):
+            self._finalizer = weakref.finalize(self, _unlink, self._path)
+
+    @property
+    def shape(self):
+        return (*self._shape, self._length)
+
+    def view(self):
+        if self._path is None:
+            return self._data[..., :self._length]
+        if self._length == 0:
+            return np.empty(self.shape, dtype=self.dtype)
+        data = np.memmap(self._path, dtype=self.dtype, mode="r",
+                         shape=(self._length, *self._shape))
+        return np.moveaxis(data, 0, -1)
+
+def is_lazy(data):
+    return isinstance(data, (LazyQuantity, LazyMap))
+
+def materialize(data):
+    if is_lazy(data):
+        return data.magnitude
+    return data
+
+def source(data):
+    while isinstance(data, LazyMap):
+        data = data.source
+    return data
+
+def lazy_binary(filename, num_channels, units, dtype=np.int16, gain=None,
+                offset=0, channels_dim=0):
+    itemsize = np.dtype(dtype).itemsize
+    num_samples = (os.path.getsize(filename) - offset) //\
+                  (itemsize * num_channels)
+    shape = (num_channels, num_samples) if channels_dim == 0 else\
+            (num_samples, num_channels)
+    data = np.memmap(filename, dtype=dtype, mode="r", offset=offset,
+                     shape=shape)
+    return LazyQuantity(data, units, scale=gain)
+
+def lazy_mat(filename, name, units):
+    dataset = h5py.File(filename, mode="r")[name]
+    axes = tuple(reversed(range(len(dataset.shape))))
+    return LazyQuantity(dataset, units, axes=axes)
+
+def read_frame(group, name, **kwargs):
+    return pd.read_csv(io.StringIO(group[name].asstr()[()]), **kwargs)
+
+def read_object(group, name):
+    return pickle.loads(group[name][()].tobytes())
+
+def write_frame(group, name, frame):
+    group.create_dataset(name, data=frame.to_csv())
+
+def write_object(group, name, obj):
+    group.create_dataset(name, data=np.void(pickle.dumps(obj)))